@@ -0,0 +1,219 @@
+# coding=utf-8
+"""
+Deterministic generator of schema-valid FictionBook files for benchmarks.
+
+    python -m benchmarks.corpus OUTPUT_DIR [--books N] [--depth D] ...
+
+The same options and seed always produce byte-identical books
+"""
+import base64
+import os
+import random
+import sys
+from optparse import OptionParser
+from xml.sax.saxutils import escape
+
+_WORDS = (
+    'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor '
+    'incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud'
+).split()
+
+_GENRES = ['sf', 'sf_fantasy', 'det_classic', 'prose_classic', 'adventure']
+
+class CorpusOptions(object):
+    """
+    Shape of generated books
+    """
+    def __init__(self, books=20, depth=2, sections=3, paragraphs=10, notes=20,
+                 binaries=2, binary_size=16 * 1024, seed=0):
+        """
+        :param depth: nesting level of sections in the main body
+        :param sections: subsections of every section above the deepest level
+        :param paragraphs: paragraphs of every deepest section
+        :param notes: footnotes per book, each referenced once from the text
+        :param binaries: images per book, the first one is the cover
+        :param binary_size: decoded size of every image in bytes
+        """
+        self.books = books
+        self.depth = depth
+        self.sections = sections
+        self.paragraphs = paragraphs
+        self.notes = notes
+        self.binaries = binaries
+        self.binary_size = binary_size
+        self.seed = seed
+
+    def asDict(self):
+        return dict(self.__dict__)
+
+class _BookGenerator(object):
+    def __init__(self, number, options):
+        """
+        :type options: CorpusOptions
+        """
+        self._number = number
+        self._options = options
+        self._random = random.Random('%s-%d' % (options.seed, number))
+        self._parts = []
+
+    def _text(self, words):
+        return escape(' '.join(self._random.choice(_WORDS) for _ in xrange(words)))
+
+    def _leafCount(self):
+        return self._options.sections ** (self._options.depth - 1)
+
+    def _description(self):
+        options, n = self._options, self._number
+        cover = ''
+        if options.binaries:
+            cover = '<coverpage><image l:href="#img%d-0"/></coverpage>' % n
+
+        return (
+            '<description><title-info>'
+            '<genre>%(genre)s</genre>'
+            '<author><first-name>Author</first-name><last-name>N%(author)d</last-name></author>'
+            '<book-title>Book %(n)d</book-title>'
+            '<annotation><p>%(annotation)s</p></annotation>'
+            '<date>%(year)d</date>%(cover)s<lang>en</lang>'
+            '<sequence name="Series %(series)d" number="%(n)d"/>'
+            '</title-info><document-info>'
+            '<author><nickname>generator</nickname></author><date>2010</date>'
+            '<src-url>http://example.com/book/%(n)d</src-url>'
+            '<id>benchmark-%(seed)s-%(n)d</id><version>1.0</version>'
+            '</document-info></description>\n'
+        ) % dict(
+            genre=self._random.choice(_GENRES), author=n % 7, n=n, series=n % 3,
+            annotation=self._text(20), year=self._random.randint(1900, 2010),
+            cover=cover, seed=options.seed,
+        )
+
+    def _section(self, depth, leaves):
+        """
+        :param leaves: iterator numbering the deepest sections
+        """
+        self._parts.append('<section><title><p>%s</p></title>\n' % self._text(3))
+        if depth < self._options.depth:
+            for _ in xrange(self._options.sections):
+                self._section(depth + 1, leaves)
+        else:
+            self._leaf(next(leaves))
+        self._parts.append('</section>\n')
+
+    def _leaf(self, leaf):
+        options, n = self._options, self._number
+        leafCount = self._leafCount()
+        # Notes and images are spread over the deepest sections evenly
+        notes = [k for k in xrange(options.notes) if k % leafCount == leaf]
+        images = [k for k in xrange(1, options.binaries) if k % leafCount == leaf]
+
+        for pos in xrange(max(options.paragraphs, 1)):
+            text = self._text(40)
+            if pos < len(notes):
+                text += ' <a l:href="#note%d-%d" type="note">%d</a>' % (n, notes[pos], notes[pos] + 1)
+            self._parts.append('<p>%s</p>\n' % text)
+
+        for note in notes[options.paragraphs:]:
+            self._parts.append('<p><a l:href="#note%d-%d" type="note">%d</a></p>\n' % (n, note, note + 1))
+
+        for image in images:
+            self._parts.append('<image l:href="#img%d-%d"/>\n' % (n, image))
+
+    def _notes(self):
+        if not self._options.notes:
+            return
+
+        self._parts.append('<body name="notes"><title><p>Notes</p></title>\n')
+        for k in xrange(self._options.notes):
+            self._parts.append(
+                '<section id="note%d-%d"><title><p>%d</p></title><p>%s</p></section>\n'
+                % (self._number, k, k + 1, self._text(15))
+            )
+        self._parts.append('</body>\n')
+
+    def _binaries(self):
+        size = self._options.binary_size
+        for k in xrange(self._options.binaries):
+            data = ('%0*x' % (2 * size, self._random.getrandbits(8 * size))).decode('hex') if size else ''
+            self._parts.append(
+                '<binary id="img%d-%d" content-type="image/png">%s</binary>\n'
+                % (self._number, k, base64.b64encode(data))
+            )
+
+    def generate(self):
+        self._parts = [
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<FictionBook xmlns="http://www.gribuser.ru/xml/fictionbook/2.0" '
+            'xmlns:l="http://www.w3.org/1999/xlink">\n',
+            self._description(),
+            '<body><title><p>Book %d</p></title>\n' % self._number,
+        ]
+        self._section(1, iter(xrange(self._leafCount())))
+        self._parts.append('</body>\n')
+        self._notes()
+        self._binaries()
+        self._parts.append('</FictionBook>\n')
+        return ''.join(self._parts)
+
+def generate_book(number, options):
+    """
+    :type options: CorpusOptions
+    :rtype: str
+    """
+    return _BookGenerator(number, options).generate()
+
+def generate(directory, options):
+    """
+    Writes options.books books into directory
+
+    :type options: CorpusOptions
+    :return: paths of the written books
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    paths = []
+    for number in xrange(options.books):
+        path = os.path.join(directory, 'book%05d.fb2' % number)
+        with open(path, 'wb') as f:
+            f.write(generate_book(number, options))
+        paths.append(path)
+
+    return paths
+
+def add_corpus_options(parser):
+    """
+    Adds CorpusOptions fields to an OptionParser
+    """
+    defaults = CorpusOptions()
+    for name, help in [
+        ('books', 'number of books'),
+        ('depth', 'nesting level of sections'),
+        ('sections', 'subsections per section'),
+        ('paragraphs', 'paragraphs per deepest section'),
+        ('notes', 'footnotes per book'),
+        ('binaries', 'images per book'),
+        ('binary_size', 'decoded bytes per image'),
+        ('seed', 'random seed'),
+    ]:
+        parser.add_option('--' + name.replace('_', '-'), dest=name, action='store', type='int',
+                          default=getattr(defaults, name), help=help + ' [default: %default]')
+
+def corpus_options(options):
+    """
+    CorpusOptions from OptionParser results
+    """
+    return CorpusOptions(**dict((k, getattr(options, k)) for k in CorpusOptions().asDict()))
+
+parser = OptionParser(usage='%prog OUTPUT_DIR [options]')
+add_corpus_options(parser)
+
+def main(sys_argv):
+    options, args = parser.parse_args(sys_argv[1:])
+    if len(args) != 1:
+        parser.error('No output directory')
+
+    paths = generate(args[0], corpus_options(options))
+    print 'Generated %d books in %s' % (len(paths), args[0])
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,116 @@
+# coding=utf-8
+"""
+Time and memory of every merge stage on a synthetic corpus.
+
+    python -m benchmarks.stages [--corpus DIR] [--json FILE] [corpus options]
+
+Without --corpus books are generated into a temporary directory.
+Books are merged by the functions fb2merge uses and measured by
+fb2tools.metrics, as fb2merge --stats does; the report sums wall and
+CPU time of each stage over all books. "maxrss_kb" is the peak resident
+size of the process (ru_maxrss) reached by the end of a stage,
+"rss_delta_kb" how much the stage changed the resident size.
+Reports of two runs can be compared with --compare
+"""
+from collections import OrderedDict
+import json
+from optparse import OptionParser
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from lxml import etree
+from fb2tools.book import Book
+from fb2tools.bookcreator import BookCreator, BookStat
+from fb2tools.metrics import metrics
+from fb2tools.prepare import prepareBook
+from benchmarks.corpus import add_corpus_options, corpus_options, generate
+
+def run(paths, output):
+    """
+    Merges paths into output the way fb2merge does, stages are measured
+    when fb2tools.metrics is enabled
+    """
+    stat = BookStat()
+    creator = BookCreator(u'Benchmark')
+
+    for bookID, path in enumerate(paths):
+        prepared = prepareBook(bookID, path)
+        if prepared is None:
+            continue
+
+        metrics.attach(bookID, prepared.metrics)
+        with metrics.book(bookID, path):
+            stat.add(prepared)
+            creator.insertBook(prepared.info.key, prepared.section, prepared.notes, bookID)
+            for binary in prepared.binaries:
+                creator.addBinary(binary)
+
+    merged = creator.finish(stat)
+    with metrics.stage('save'):
+        merged.saveAs(output)
+
+parser = OptionParser()
+parser.add_option('--corpus', dest='corpus', action='store',
+                  help='directory of books to merge instead of a generated corpus')
+parser.add_option('--json', dest='json', action='store',
+                  help='write the report to JSON file')
+parser.add_option('--compare', dest='compare', action='store',
+                  help='JSON report of an earlier run to compare wall time with')
+add_corpus_options(parser)
+
+def main(sys_argv):
+    options, args = parser.parse_args(sys_argv[1:])
+
+    workdir = tempfile.mkdtemp(prefix='fb2bench')
+    try:
+        corpus = corpus_options(options)
+        if options.corpus:
+            paths = sorted(os.path.join(options.corpus, x) for x in os.listdir(options.corpus))
+        else:
+            paths = generate(os.path.join(workdir, 'corpus'), corpus)
+
+        Book.loadSchema()
+        metrics.enable()
+        start = time.time()
+        run(paths, os.path.join(workdir, 'merged.fb2'))
+        total = time.time() - start
+    finally:
+        shutil.rmtree(workdir)
+
+    measured = metrics.report()
+    report = OrderedDict([
+        ('python', platform.python_version()),
+        ('lxml', etree.__version__),
+        ('corpus', options.corpus or corpus.asDict()),
+        ('books', len(paths)),
+        ('wall', total),
+        ('maxrss_kb', measured['maxrss_kb']),
+        ('stages', measured['stages']),
+        ('counters', measured['counters']),
+    ])
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)['stages']
+
+    for name, stage in report['stages'].iteritems():
+        line = '%-16s %8.1fms  cpu %8.1fms  maxrss %7dKB' % (
+            name, stage['wall'] * 1000, stage['cpu'] * 1000, stage['maxrss_kb']
+        )
+        if baseline is not None and name in baseline and baseline[name]['wall']:
+            line += '  %+6.1f%%' % ((stage['wall'] / baseline[name]['wall'] - 1) * 100)
+        print line
+    print '%-16s %8.1fms' % ('total', total * 1000)
+
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    return report
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,69 @@
+# coding=utf-8
+"""
+Startup cost of fb2tools: every sample runs in a fresh interpreter.
+
+    python -m benchmarks.startup [-n RUNS] [--baseline-path CHECKOUT]
+
+"import" is what a tool pays for importing fb2tools now. "eager" adds
+what every import cost before the schema, the selectors and rarely used
+modules became lazy: importing multiprocessing, uuid and sqlite3 and
+compiling the schema and all selectors. With --baseline-path the same
+modules are also imported from another checkout, e.g. an older commit
+"""
+import json
+from optparse import OptionParser
+import os
+import subprocess
+import sys
+
+_SAMPLE = r'''
+import json, time
+t0 = time.time()
+import lxml.etree
+t1 = time.time()
+if %(eager)r:
+    import multiprocessing, sqlite3, uuid
+import fb2tools.book, fb2tools.bookcreator, fb2tools.prepare
+if %(eager)r:
+    from fb2tools import book, xpath
+    book.Book.loadSchema()
+    for module in (book, xpath):
+        for selector in vars(module).values():
+            if isinstance(selector, xpath.LazyXPath):
+                selector(lxml.etree.Element('x'))
+t2 = time.time()
+print json.dumps({'lxml': t1 - t0, 'fb2tools': t2 - t1})
+'''
+
+# Checkout the benchmark belongs to
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+parser = OptionParser()
+parser.add_option('-n', '--runs', dest='runs', action='store', type='int', default=10)
+parser.add_option('--baseline-path', dest='baseline_path', action='store', metavar='CHECKOUT',
+                  help='also time importing fb2tools of another checkout')
+
+def sample(eager=False, root=_ROOT):
+    """
+    :param root: directory fb2tools is imported from
+    """
+    out = subprocess.check_output([sys.executable, '-c', _SAMPLE % {'eager': eager}], cwd=root)
+    return json.loads(out)
+
+def main(sys_argv):
+    options, args = parser.parse_args(sys_argv[1:])
+
+    cases = [('import', {}), ('eager', {'eager': True})]
+    if options.baseline_path:
+        cases.append(('baseline', {'root': os.path.abspath(options.baseline_path)}))
+
+    report = {}
+    for name, kwargs in cases:
+        runs = [sample(**kwargs)['fb2tools'] for _ in xrange(options.runs)]
+        report[name] = {'min': min(runs), 'median': sorted(runs)[len(runs) // 2]}
+        print '%-16s min %6.1fms  median %6.1fms' % (name, report[name]['min'] * 1000, report[name]['median'] * 1000)
+
+    return report
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,44 @@
+# coding=utf-8
+import sys
+from optparse import OptionParser
+import logging
+from fb2tools import ArgumentsException
+from fb2tools.library import LibraryIndex, index_library
+
+logger = logging.getLogger('fb2merge')
+frmttr = logging.Formatter('%(asctime)s %(name)s %(levelname)s %(message)s', '%Y-%m-%d %H:%M:%S')
+shdlr = logging.StreamHandler(sys.stderr)
+shdlr.setFormatter(frmttr)
+logger.addHandler(shdlr)
+
+parser = OptionParser(usage='%prog -o INDEX [options] DIRECTORY|ARCHIVE|PATTERN...')
+parser.add_option('-o', '--output', dest='output', action='store',
+                  help='sqlite file of the index, updated when it exists')
+parser.add_option('-v', '--verbose', dest='debug', action='store_true', default=False)
+parser.add_option('-j', '--jobs', dest='jobs', action='store', type='int', default=1,
+                  help='scan books in JOBS worker processes')
+
+def main(sys_argv):
+    """
+    Indexes title, authors, year, sequence, language and genres of books,
+    reading only their descriptions
+    """
+    options, args = parser.parse_args(sys_argv[1:])
+    logger.setLevel(logging.DEBUG if options.debug else logging.INFO)
+
+    if not options.output:
+        raise ArgumentsException('No output specified')
+    if not args:
+        raise ArgumentsException('No books to index')
+    if options.jobs < 1:
+        raise ArgumentsException('Jobs number must be positive')
+
+    scanned, unchanged, removed, failed = index_library(args, LibraryIndex(options.output), options.jobs)
+    logger.info('%d books scanned, %d unchanged, %d removed, %d unreadable' % (scanned, unchanged, removed, failed))
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv)
+    except ArgumentsException, e:
+        logger.critical(e)
+        sys.exit(1)
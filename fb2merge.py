@@ -1,15 +1,22 @@
 # coding=utf-8
-from itertools import chain, imap
+import functools
+import json
 import sys
 from optparse import OptionParser
 import logging
-import glob
+from lxml.etree import DocumentInvalid, XMLSyntaxError
+from fb2tools import ArgumentsException
+from fb2tools.batch import load_manifest, run_jobs
 from fb2tools.book import Book
-from lxml.etree import DocumentInvalid
-import os
-from fb2tools import fb2tag, ArgumentsException, NotAFBZException
-from fb2tools.bookcreator import BookCreator, BookStat
-from fb2tools.section import Section
+from fb2tools.bookcreator import BookCreator, BookStat, SpooledBookCreator, VolumeCreator
+from fb2tools.cache import MemoryCache, PrepareCache
+from fb2tools.dedup import DEDUP_MODES, KEEP_FIRST, KEEP_POLICIES, deduplicate
+from fb2tools.images import IMAGE_FORMATS, ImageCache, ImageOptions, ImageRecompressor, available as images_available
+from fb2tools.inputs import ReadAhead, expand
+from fb2tools.metrics import metrics
+from fb2tools.prepare import prepareBooks
+from fb2tools.service import MergeService, serve
+from fb2tools.validation import VALIDATE_MODES, VALIDATE_ALL, ValidationCache, validates_input, validates_output
 
 logger = logging.getLogger('fb2merge')
 frmttr = logging.Formatter('%(asctime)s %(name)s %(levelname)s %(message)s', '%Y-%m-%d %H:%M:%S')
@@ -19,86 +26,274 @@ logger.addHandler(shdlr)
 
 parser = OptionParser()
 parser.add_option('-z', '--zip', dest='zip', action='store_true', default=False)
+parser.add_option('--zip-level', dest='zip_level', action='store', type='int',
+                  help='deflate level of -z output, from 0 (store) to 9 (smallest)')
 parser.add_option('-o', '--output', dest='output', action='store')
 parser.add_option('-v', '--verbose', dest='debug', action='store_true', default=False)
 parser.add_option('-t', '--title', dest='title', action='store')
+parser.add_option('-j', '--jobs', dest='jobs', action='store', type='int', default=1,
+                  help='prepare books in JOBS worker processes')
+parser.add_option('--validate', dest='validate', action='store', type='choice',
+                  choices=VALIDATE_MODES, default=VALIDATE_ALL,
+                  help='schema validation of input books, merged output, both or none [default: %default]')
+parser.add_option('--full-output-validation', dest='full_output_validation', action='store_true', default=False,
+                  help='validate the whole merged document instead of the parts built by the merge')
+parser.add_option('-a', '--append-to', dest='append_to', action='store',
+                  help='insert books into a book merged before instead of starting a new one')
+parser.add_option('--read-ahead', dest='read_ahead', action='store', type='int', default=ReadAhead.DEPTH,
+                  help='read up to N input files ahead of parsing, in parallel; 0 reads each when parsed. '
+                       'Off with -j above 1, pool workers read their own inputs [default: %default]')
+parser.add_option('--read-ahead-budget', dest='read_ahead_budget', action='store', type='int',
+                  default=ReadAhead.BUDGET // (1024 * 1024),
+                  help='MB of inputs held by --read-ahead, larger inputs are read when parsed [default: %default]')
+parser.add_option('--cache', dest='cache', action='store',
+                  help='sqlite file keeping prepared books and recompressed images between runs')
+parser.add_option('--validation-cache', dest='validation_cache', action='store',
+                  help='sqlite file remembering input books that passed validation')
+parser.add_option('--dedup', dest='dedup', action='store', type='choice', choices=DEDUP_MODES,
+                  help='skip copies of a book: with the same content (exact) '
+                       'or the same title and authors (metadata)')
+parser.add_option('--dedup-keep', dest='dedup_keep', action='store', type='choice',
+                  choices=KEEP_POLICIES, default=KEEP_FIRST,
+                  help='copy to keep: first given, largest or newest by document version [default: %default]')
+parser.add_option('--max-image-size', dest='max_image_size', action='store', type='int',
+                  help='downscale images to at most PX pixels on the longest side (needs PIL)')
+parser.add_option('--image-format', dest='image_format', action='store', type='choice', choices=IMAGE_FORMATS,
+                  help='re-encode images as jpeg or png (needs PIL)')
+parser.add_option('--image-quality', dest='image_quality', action='store', type='int',
+                  help='JPEG quality of re-encoded images [default: 85] (needs PIL)')
+parser.add_option('--memory-budget', dest='memory_budget', action='store', type='int',
+                  help='keep at most MB of merged books in memory, spool the rest to temporary files')
+parser.add_option('--max-volume-size', dest='max_volume_size', action='store', type='int',
+                  help='split output into volumes of about MB each, saved as OUTPUT.1.fb2, OUTPUT.2.fb2...')
+parser.add_option('--max-books-per-volume', dest='max_books_per_volume', action='store', type='int',
+                  help='split output into volumes of at most N books each')
+parser.add_option('--manifest', dest='manifest', action='store',
+                  help='run merge jobs listed in JSON file, spread over JOBS processes')
+parser.add_option('--serve', dest='serve', action='store', metavar='ADDRESS',
+                  help='run as a merge service on a loopback HOST:PORT or a Unix socket path '
+                       'only the user can connect to, taking manifest entries as JSON, JOBS at a time')
+parser.add_option('--cache-memory', dest='cache_memory', action='store', type='int', default=256,
+                  help='with --serve, keep up to MB of prepared books in memory [default: %default]')
+parser.add_option('--queue-size', dest='queue_size', action='store', type='int', default=64,
+                  help='with --serve, queued jobs beyond which new jobs are refused [default: %default]')
+parser.add_option('--stats', dest='stats', action='store',
+                  help='write time, memory and counters per stage and per book to JSON file')
+parser.add_option('--profile', dest='profile', action='store',
+                  help='run under cProfile and save pstats data to file; worker processes are not profiled')
 
-def main(sys_argv):
-    options, args = parser.parse_args(sys_argv[1:])
-    logger.setLevel(logging.DEBUG if options.debug else logging.INFO)
+def image_options(options):
+    """
+    :rtype: ImageOptions
+    """
+    if options.max_image_size is None and options.image_format is None and options.image_quality is None:
+        return None
+
+    quality = options.image_quality if options.image_quality is not None else 85
+    return ImageOptions(options.max_image_size, options.image_format, quality)
+
+def splits_volumes(options):
+    return options.max_volume_size is not None or options.max_books_per_volume is not None
+
+def volume_filename(output, number):
+    """
+    out.fb2 -> out.1.fb2
+    """
+    base = output[:-len('.fb2')] if output.endswith('.fb2') else output
+    return '%s.%d.fb2' % (base, number)
 
+def check_options(options):
     if not options.output:
         raise ArgumentsException('No output specified')
-    if not options.title:
+    if not options.title and not options.append_to:
         raise ArgumentsException('No book title')
+    if options.jobs < 1:
+        raise ArgumentsException('Jobs number must be positive')
+    if options.zip_level is not None and not 0 <= options.zip_level <= 9:
+        raise ArgumentsException('Zip level must be from 0 to 9')
+    if splits_volumes(options):
+        if options.append_to:
+            raise ArgumentsException('Volumes can not be appended to')
+        if min(x for x in (options.max_volume_size, options.max_books_per_volume) if x is not None) < 1:
+            raise ArgumentsException('Volume limits must be positive')
+    if options.read_ahead < 0 or options.read_ahead_budget < 0:
+        raise ArgumentsException('Read-ahead depth and budget must not be negative')
+    if options.memory_budget is not None and options.memory_budget < 1:
+        raise ArgumentsException('Memory budget must be positive')
+    if options.dedup is not None and options.dedup not in DEDUP_MODES:
+        raise ArgumentsException('Unknown dedup mode %s' % options.dedup)
+    if options.dedup_keep not in KEEP_POLICIES:
+        raise ArgumentsException('Unknown dedup policy %s' % options.dedup_keep)
+    if image_options(options) is not None:
+        if not images_available():
+            raise ArgumentsException('Image options need PIL (Pillow)')
+        if options.max_image_size is not None and options.max_image_size < 1:
+            raise ArgumentsException('Image size must be positive')
+        if options.image_quality is not None and not 1 <= options.image_quality <= 95:
+            raise ArgumentsException('Image quality must be from 1 to 95')
+        if options.image_format is not None and options.image_format not in IMAGE_FORMATS:
+            raise ArgumentsException('Unknown image format %s' % options.image_format)
+    if options.validate not in VALIDATE_MODES:
+        raise ArgumentsException('Unknown validation mode %s' % options.validate)
 
-    books_combined = BookCreator(options.title.decode('utf-8'))
-    bookstats = BookStat()
+def main(sys_argv):
+    options, args = parser.parse_args(sys_argv[1:])
+    logger.setLevel(logging.DEBUG if options.debug else logging.INFO)
+
+    if options.manifest:
+        return run_manifest(options, args)
+    if options.serve:
+        return run_service(options, args)
+
+    check_options(options)
 
-    for bookID, file in enumerate(chain(*imap(glob.iglob, args))):
-        if not os.path.isfile(file):
-            logger.info('Skipping %s: not a file' % file)
-            continue
+    if options.stats:
+        metrics.enable()
 
+    if options.profile:
+        import cProfile
+
+        profiler = cProfile.Profile()
         try:
-            book = Book.fromFile(file, True)
-        except NotAFBZException:
-            logger.warning('Not a valid fbz file: ' + file)
-            continue
+            profiler.runcall(merge, options, expand(args))
+        finally:
+            profiler.dump_stats(options.profile)
+    else:
+        merge(options, expand(args))
+
+    if options.stats:
+        with open(options.stats, 'w') as f:
+            json.dump(metrics.report(), f, indent=2)
+
+def run_manifest(options, args):
+    """
+    Runs the jobs of a manifest in this process, or in a pool of options.jobs processes.
+    Schema and selectors are compiled once per process instead of once per job
 
-        bodies = book.getBodies()
+    :return: number of failed jobs
+    """
+    if args:
+        raise ArgumentsException('Inputs are given by the manifest')
+    if options.stats or options.profile:
+        raise ArgumentsException('--stats and --profile are not supported with --manifest')
+    if options.jobs < 1:
+        raise ArgumentsException('Jobs number must be positive')
 
-        if len(bodies) > 2 or len(bodies) == 0:
-            logger.error("Book %s has %d bodies" % (file, len(bodies)))
-            continue
+    jobs = load_manifest(options.manifest, options)
+    for job in jobs:
+        try:
+            check_options(job.options)
+        except ArgumentsException, e:
+            raise ArgumentsException('%s: %s' % (job, e))
 
-        if len(bodies) == 2 and bodies[1].attrib.get('name') != 'notes':
-            logger.error("Book %s second body bodies is not [notes]" % file)
-            continue
+    failed = run_jobs(jobs, merge, options.jobs)
+    if failed:
+        logger.error('%d of %d jobs failed' % (len(failed), len(jobs)))
 
-        ## #############################
+    return len(failed)
 
-        bookinfo = bookstats.process(book, bookID)
+def run_service(options, args):
+    """
+    Serves merge jobs until interrupted
+    """
+    if args:
+        raise ArgumentsException('Inputs are given by the jobs')
+    if options.manifest or options.stats or options.profile:
+        raise ArgumentsException('--manifest, --stats and --profile are not supported with --serve')
+    if options.jobs < 1:
+        raise ArgumentsException('Jobs number must be positive')
+    if options.cache_memory < 0 or options.queue_size < 1:
+        raise ArgumentsException('Cache memory and queue size must be positive')
 
-        ##################
+    Book.loadSchema()
+    cache = MemoryCache(options.cache_memory * 1024 * 1024, options.cache)
+    service = MergeService(functools.partial(merge, cache=cache), options, check_options,
+                           options.jobs, options.queue_size, cache)
+    serve(options.serve, service)
 
-        sp = Section(bodies[0])
-        new_section = sp.rebuild_section(
-            annotation=book.getAnnotation(),
-            cover=book.getCover(),
-            epigraphs=book.getEpigraphs(),
-            title=book.getTitle(),
-        )
+def merge(options, paths, cache=None):
+    """
+    :param cache: cache of prepared books instead of the one options.cache names
+    :type cache: fb2tools.cache.PrepareCache
+    :return: False when the merged book is invalid and was not saved
+    """
+    title = options.title.decode('utf-8') if options.title else None
+    bookstats = BookStat()
 
-        booknotes = []
-        if len(bodies) > 1:
-            for _pos, noteSection in enumerate(bodies[1]):
-                if not noteSection.tag == fb2tag('section'):
-                    if _pos or not noteSection.tag == fb2tag('title') :
-                        logger.warn("Wrong note: %s in %s" % (noteSection.tag, file))
-                    continue
+    if options.memory_budget:
+        creator, creatorOptions = SpooledBookCreator, {'budget': options.memory_budget * 1024 * 1024}
+    else:
+        creator, creatorOptions = BookCreator, {}
 
-                booknotes.append(noteSection)
+    volumes = splits_volumes(options)
+    if volumes:
+        maxSize = options.max_volume_size * 1024 * 1024 if options.max_volume_size else None
+        books_combined = VolumeCreator(title, options.max_books_per_volume, maxSize,
+                                       creatorOptions.get('budget', VolumeCreator.BUDGET))
+    elif options.append_to:
+        try:
+            with metrics.stage('append_load'):
+                merged = Book.fromFile(options.append_to, validate=False)
+                books_combined = creator.fromMerged(merged, bookstats, title, **creatorOptions)
+        except (IOError, ValueError, XMLSyntaxError), e:
+            raise ArgumentsException('Cannot append to %s: %s' % (options.append_to, e))
+    else:
+        books_combined = creator(title, **creatorOptions)
 
-        books_combined.insertBook(bookinfo.key, new_section, booknotes)
+    if options.dedup:
+        paths = deduplicate(list(paths), options.dedup, options.dedup_keep, options.jobs)
 
-        for binary in book.getBinaries():
-            bID = binary.attrib['id']
-            if not bookinfo.referes(bID):
-                logger.info('Skipping binary %s' % bID)
-                continue
+    validationCache = ValidationCache(options.validation_cache) if options.validation_cache else None
+    if cache is None and options.cache:
+        cache = PrepareCache(options.cache)
 
-            books_combined.addBinary(binary)
+    images = None
+    imageOptions = image_options(options)
+    if imageOptions is not None:
+        images = ImageRecompressor(imageOptions, ImageCache(options.cache) if options.cache else None)
+
+    books = prepareBooks(paths, options.jobs, books_combined.nextBookID,
+                         readAhead=options.read_ahead, readAheadBudget=options.read_ahead_budget * 1024 * 1024,
+                         validate=validates_input(options.validate), validationCache=validationCache,
+                         cache=cache, images=images)
+
+    for prepared in books:
+        metrics.attach(prepared.bookID, prepared.metrics)
+        with metrics.book(prepared.bookID, prepared.path):
+            if volumes:
+                # Every volume is described by its own books
+                books_combined.insertBook(prepared.info.key, prepared.section, prepared.notes, prepared.bookID,
+                                          prepared.description)
+            else:
+                bookstats.add(prepared)
+                books_combined.insertBook(prepared.info.key, prepared.section, prepared.notes, prepared.bookID)
+
+            for binary in prepared.binaries:
+                books_combined.addBinary(binary)
 
     try:
-        book_output = books_combined.finish(bookstats)
-        book_output.saveAs(options.output, options.zip)
+        # Fragment validation trusts book contents, that only holds for validated input
+        fullValidation = options.full_output_validation or not validates_input(options.validate)
+        if volumes:
+            # Volumes are saved as they are built, memory holds one of them
+            for number, volume in books_combined.volumes(validates_output(options.validate), fullValidation):
+                with metrics.stage('save'):
+                    volume.saveAs(volume_filename(options.output, number), options.zip, zip_level=options.zip_level)
+            return True
+
+        book_output = books_combined.finish(bookstats, validates_output(options.validate), fullValidation)
+        with metrics.stage('save'):
+            book_output.saveAs(options.output, options.zip, zip_level=options.zip_level)
     except DocumentInvalid, e:
         logger.critical('Not a valid book: %s' % e)
+        return False
+
+    return True
 
 if __name__ == '__main__':
     try:
-        main(sys.argv)
+        if main(sys.argv):
+            sys.exit(1)
     except ArgumentsException, e:
         logger.critical(e)
         sys.exit(1)
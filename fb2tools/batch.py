@@ -0,0 +1,138 @@
+# coding=utf-8
+import copy
+import json
+import logging
+from itertools import imap
+from . import ArgumentsException, LIB_NAME, inputs
+from .book import Book
+
+logger = logging.getLogger(LIB_NAME)
+
+# Manifest keys and the options they set
+JOB_OPTIONS = {
+    'title': 'title',
+    'inputs': None,
+    'output': 'output',
+    'zip': 'zip',
+    'zip_level': 'zip_level',
+    'append_to': 'append_to',
+    'validate': 'validate',
+    'memory_budget': 'memory_budget',
+    'max_volume_size': 'max_volume_size',
+    'max_books_per_volume': 'max_books_per_volume',
+    'dedup': 'dedup',
+    'dedup_keep': 'dedup_keep',
+    'max_image_size': 'max_image_size',
+    'image_format': 'image_format',
+    'image_quality': 'image_quality',
+}
+
+class Job(object):
+    """
+    Single merge of a manifest: options as fb2merge parses them and input paths
+    """
+    def __init__(self, number, options, paths):
+        self.number = number
+        self.options = options
+        self.paths = paths
+        # Input bytes, estimate of the job duration
+        self.size = sum(inputs.size(path) for path in paths)
+
+    def __str__(self):
+        return 'job %d (%s)' % (self.number, self.options.output)
+
+def _str(value):
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+def load_manifest(path, defaults):
+    """
+    Reads jobs from a JSON manifest: a list of objects, or an object with
+    such list under "jobs". Every job has "inputs", a list of input patterns,
+    and may set the options in JOB_OPTIONS; other options are taken from defaults
+
+    :type defaults: optparse.Values
+    :rtype: list[Job]
+    """
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError), e:
+        raise ArgumentsException('Cannot read manifest %s: %s' % (path, e))
+
+    entries = manifest.get('jobs') if isinstance(manifest, dict) else manifest
+    if not isinstance(entries, list):
+        raise ArgumentsException('Manifest %s has no job list' % path)
+
+    return [parse_job(number, entry, defaults) for number, entry in enumerate(entries)]
+
+def parse_job(number, entry, defaults):
+    """
+    Makes a job of a single manifest entry
+
+    :type defaults: optparse.Values
+    :rtype: Job
+    """
+    if not isinstance(entry, dict):
+        raise ArgumentsException('Job %d of manifest is not an object' % number)
+
+    unknown = set(entry) - set(JOB_OPTIONS)
+    if unknown:
+        raise ArgumentsException('Job %d has unknown keys: %s' % (number, ', '.join(sorted(unknown))))
+
+    patterns = entry.get('inputs')
+    if not isinstance(patterns, list) or not patterns:
+        raise ArgumentsException('Job %d has no inputs' % number)
+
+    options = copy.copy(defaults)
+    for key, value in entry.iteritems():
+        if JOB_OPTIONS[key] is not None:
+            setattr(options, JOB_OPTIONS[key], _str(value))
+
+    return Job(number, options, list(inputs.expand(map(_str, patterns))))
+
+def _runJob(args):
+    run, job = args
+    try:
+        return job, run(job.options, job.paths) is not False
+    except Exception, e:
+        # A failed job must not stop the rest of the batch
+        logger.exception('%s failed: %s' % (job, e))
+        return job, False
+
+def run_jobs(jobs, run, processes=1):
+    """
+    Calls run(options, paths) for every job, the largest jobs first.
+    A job fails when run raises or returns False.
+    With processes > 1 jobs are spread over a process pool,
+    each job then prepares its books in a single process
+
+    :type jobs: list[Job]
+    :return: jobs that failed
+    """
+    jobs = sorted(jobs, key=lambda job: job.size, reverse=True)
+    if processes <= 1:
+        results = imap(_runJob, ((run, job) for job in jobs))
+        pool = None
+    else:
+        from multiprocessing import Pool
+
+        for job in jobs:
+            job.options.jobs = 1
+
+        # Workers inherit the compiled schema instead of compiling it each
+        Book.loadSchema()
+        pool = Pool(processes)
+        results = pool.imap_unordered(_runJob, [(run, job) for job in jobs])
+
+    failed = []
+    try:
+        for job, ok in results:
+            logger.info('%s %s' % (job, 'done' if ok else 'failed'))
+            if not ok:
+                failed.append(job)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return failed
@@ -0,0 +1,190 @@
+# coding=utf-8
+import base64
+from collections import OrderedDict
+import hashlib
+import re
+import tempfile
+from . import LIB_NAME
+from .xml import build_element as _e
+
+_BASE64_ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+_CANONICAL_BASE64 = re.compile(r'[A-Za-z0-9+/]*={0,2}\Z')
+_NOT_BASE64 = re.compile(r'[^A-Za-z0-9+/=]+')
+
+def is_canonical_base64(text):
+    """
+    True when text is exactly what base64.b64encode gives for its content:
+    one line, padded, unused bits of the last symbol zero
+    """
+    if not text:
+        return True
+
+    if len(text) % 4 or not _CANONICAL_BASE64.match(text):
+        return False
+
+    padding = len(text) - len(text.rstrip('='))
+    if not padding:
+        return True
+
+    last = _BASE64_ALPHABET.index(text[-padding - 1])
+    return not last & (0x0f if padding == 2 else 0x03)
+
+def decode_chunks(text, size=64 * 1024):
+    """
+    Decodes base64 text piece by piece, skipping whitespace
+    """
+    rest = ''
+    for start in xrange(0, len(text), size):
+        piece = rest + _NOT_BASE64.sub('', text[start:start + size])
+        cut = len(piece) - len(piece) % 4
+        if cut:
+            yield base64.b64decode(piece[:cut])
+        rest = piece[cut:]
+
+    if rest:
+        yield base64.b64decode(rest)
+
+class ChunkReader(object):
+    """
+    Read-only file object over an iterator of strings
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = ''
+        self._pos = 0
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self._pos >= len(self._buffer):
+                chunk = next(self._chunks, None)
+                if chunk is None:
+                    break
+                self._buffer, self._pos = chunk, 0
+                continue
+
+            end = len(self._buffer) if size < 0 else min(len(self._buffer), self._pos + size)
+            parts.append(self._buffer[self._pos:end])
+            if size > 0:
+                size -= end - self._pos
+            self._pos = end
+
+        return ''.join(parts)
+
+    def __iter__(self):
+        if self._pos < len(self._buffer):
+            yield self._buffer[self._pos:]
+        self._buffer, self._pos = '', 0
+
+        for chunk in self._chunks:
+            yield chunk
+
+    def close(self):
+        self._chunks = iter(())
+        self._buffer, self._pos = '', 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+class BinaryStore(object):
+    """
+    Keeps <binary> payloads in a temporary spool file,
+    only ids and attributes (content type) stay in memory.
+
+    With dedup binaries with the same decoded content and content type
+    are stored once, ids of later copies become aliases of the first one
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, dedup=True):
+        self._spool = tempfile.TemporaryFile(prefix=LIB_NAME + '-')
+        self._end = 0
+        self._binaries = OrderedDict()
+        self._dedup = dedup
+        self._hashes = {}
+        self._aliases = {}
+
+    def __len__(self):
+        return len(self._binaries)
+
+    def __contains__(self, id):
+        return id in self._binaries or id in self._aliases
+
+    def ids(self):
+        return self._binaries.keys()
+
+    def contentType(self, id):
+        return self._binaries[id][0].get('content-type')
+
+    def resolve(self, id):
+        """
+        Id of the stored binary for id, that may be an alias of a duplicate
+        """
+        return self._aliases.get(id, id)
+
+    def aliases(self):
+        return self._aliases
+
+    def add(self, binary):
+        """
+        Stores binary, returns id it should be referred by
+
+        :type binary: lxml.etree._Element
+        :rtype: str
+        """
+        bID = binary.attrib['id']
+        if bID in self:
+            raise ValueError('Duplicate binary #%s' % bID)
+
+        data = (binary.text or '').encode('ascii')
+
+        if self._dedup:
+            m = hashlib.sha1(base64.b64decode(data))
+            key = (binary.attrib.get('content-type'), m.digest())
+            if key in self._hashes:
+                self._aliases[bID] = self._hashes[key]
+                return self._hashes[key]
+
+            self._hashes[key] = bID
+
+        self._spool.seek(self._end)
+        self._spool.write(data)
+        self._binaries[bID] = (OrderedDict(binary.attrib.items()), self._end, len(data))
+        self._end += len(data)
+        return bID
+
+    def size(self, id):
+        """
+        Length of the base64 payload of binary #id
+        """
+        return self._binaries[self.resolve(id)][2]
+
+    def chunks(self, id):
+        """
+        Yields base64 payload of binary #id piece by piece
+        """
+        _attrib, offset, length = self._binaries[id]
+        while length > 0:
+            self._spool.seek(offset)
+            chunk = self._spool.read(min(length, self.CHUNK_SIZE))
+            offset += len(chunk)
+            length -= len(chunk)
+            yield chunk
+
+    def element(self, id):
+        e = _e('binary', ''.join(self.chunks(id)))
+        e.attrib.update(self._binaries[id][0])
+        return e
+
+    def write(self, writer):
+        """
+        :type writer: fb2tools.writer.StreamWriter
+        """
+        for bID, (attrib, _offset, _length) in self._binaries.iteritems():
+            writer.chunked('binary', self.chunks(bID), attrib)
+
+    def close(self):
+        self._spool.close()
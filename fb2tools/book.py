@@ -1,47 +1,96 @@
 # coding=utf-8
 from itertools import dropwhile
 from lxml import etree
-import hashlib
 from operator import attrgetter
 import base64
 import re
-from fb2tools.xpath import TITLE_INFO, SRC_TITLE_INFO, first_or_none
+import threading
+from fb2tools.xpath import TITLE_INFO, SRC_TITLE_INFO, LazyXPath, first_or_none
 import os
+from cStringIO import StringIO
 from zipfile import ZipFile
 from . import NotAFBZException, FB2_NSMAP, X_REF
 from fb2tools import fb2tag, ImageLoadException
-from xpath import ELEMENTS_WITH_ID, ELEMENTS_WITH_REF
+from xpath import ELEMENTS_WITH_ID_OR_REF, ELEMENTS_WITH_REF
 from xml import build_element as _e
 from save import SaveXml, SaveZip
+from writer import StreamWriter, write_element
+from validation import HashingReader
+from binary import ChunkReader, decode_chunks, is_canonical_base64
+from . import inputs
+from .metrics import metrics
 
-BOOK_TITLE = etree.XPath('//f:description/f:title-info/f:book-title', namespaces=FB2_NSMAP)
-ORIGINAL_TITLE = etree.XPath('//f:description/f:src-title-info/f:book-title', namespaces=FB2_NSMAP)
-BODY = etree.XPath('//f:FictionBook/f:body', namespaces=FB2_NSMAP)
+BOOK_TITLE = LazyXPath('//f:description/f:title-info/f:book-title', namespaces=FB2_NSMAP)
+ORIGINAL_TITLE = LazyXPath('//f:description/f:src-title-info/f:book-title', namespaces=FB2_NSMAP)
+BODY = LazyXPath('//f:FictionBook/f:body', namespaces=FB2_NSMAP)
+DESCRIPTION = LazyXPath('//f:FictionBook/f:description', namespaces=FB2_NSMAP)
 
-AUTHORS = etree.XPath('//f:description/f:title-info/f:author', namespaces=FB2_NSMAP)
+AUTHORS = LazyXPath('//f:description/f:title-info/f:author', namespaces=FB2_NSMAP)
 
-EPIGRAPH = etree.XPath('//f:FictionBook/f:body[0]/f:epigraph', namespaces=FB2_NSMAP)
-COVER = etree.XPath('//f:description/f:title-info/f:coverpage/f:image[starts-with(@x:href, "#")]', namespaces=FB2_NSMAP)
-ANNOTATION = etree.XPath('//f:description/f:title-info/f:annotation', namespaces=FB2_NSMAP)
+EPIGRAPH = LazyXPath('//f:FictionBook/f:body[0]/f:epigraph', namespaces=FB2_NSMAP)
+COVER = LazyXPath('//f:description/f:title-info/f:coverpage/f:image[starts-with(@x:href, "#")]', namespaces=FB2_NSMAP)
+ANNOTATION = LazyXPath('//f:description/f:title-info/f:annotation', namespaces=FB2_NSMAP)
 
-BINARIES = etree.XPath('//f:FictionBook/f:binary', namespaces=FB2_NSMAP)
+BINARIES = LazyXPath('//f:FictionBook/f:binary', namespaces=FB2_NSMAP)
 
-_DS_INFO = etree.XPath('//f:description/*[contains(local-name(), "title-info")]', namespaces=FB2_NSMAP)
+_DS_INFO = LazyXPath('//f:description/*[contains(local-name(), "title-info")]', namespaces=FB2_NSMAP)
 _TAGS_BEFORE_DATE = map(fb2tag, ['genre', 'author', 'book-title', 'annotation', 'keywords'])
 
+class SharedSchema(object):
+    """
+    XMLSchema that threads may share: validators keep their error log
+    in the instance, so validations run one at a time
+    """
+    def __init__(self, schema):
+        self._schema = schema
+        self._lock = threading.Lock()
+
+    def validate(self, tree):
+        with self._lock:
+            return self._schema.validate(tree)
+
+    def assertValid(self, tree):
+        with self._lock:
+            self._schema.assertValid(tree)
+
+class LazySchema(object):
+    """
+    XMLSchema compiled on first access, shared by all classes using it
+    """
+    def __init__(self, path):
+        self.path = path
+        self._schema = None
+        self._lock = threading.Lock()
+
+    def __get__(self, obj, cls):
+        if self._schema is None:
+            with self._lock:
+                if self._schema is None:
+                    self._schema = SharedSchema(etree.XMLSchema(file=self.path))
+
+        return self._schema
+
 class Book(object):
+    ID_PREFIX = 'b%s-'
+
     FB2_SCHEMA = os.path.join(os.path.dirname(__file__), 'schema', 'FictionBook2.1.xsd')
-    SCHEMA = etree.XMLSchema(file=FB2_SCHEMA)
+    SCHEMA = LazySchema(FB2_SCHEMA)
 
-    def __init__(self, tree, strict=False, saveMethod=None):
+    def __init__(self, tree, strict=False, saveMethod=None, validate=True):
         """
         :type tree: lxml.etree._ElementTree
+        :param validate: when False schema validation is skipped and isValid() is None
         """
         self._tree = tree
         self._strict = strict
         self._saveMethod = saveMethod
+        # Image binaries by id, see _imageBinary. Methods changing binaries
+        # or ids reset it; parseSelective drops binaries before it is built
+        self._images = None
 
-        if self._strict:
+        if not validate:
+            self._valid = None
+        elif self._strict:
             self.SCHEMA.assertValid(self._tree)
             self._valid = True
         else:
@@ -50,22 +99,128 @@ class Book(object):
     def isValid(self):
         return self._valid
 
+    def markValid(self):
+        """
+        Marks the book valid without schema validation,
+        for trees that were checked by other means
+        """
+        self._valid = True
+
     @classmethod
-    def fromFile(cls, path, strict=False):
-        fo = open(path, 'r')
+    def fromFile(cls, path, strict=False, validate=True, cache=None, selective=False, data=None):
+        """
+        Path may name a member of a zip archive as archive.zip!member.
+        With selective binaries nothing refers to are dropped while parsing,
+        such a book can't be saved back
+
+        :type cache: fb2tools.validation.ValidationCache
+        :param data: content of path when it is already read
+        """
+        _archive, member = inputs.split_archive_path(path)
+        if data is None and member is not None:
+            data = inputs.read(path)
+
+        fo = StringIO(data) if data is not None else open(path, 'r')
         saveMethod = SaveXml(path)
         if path.endswith('.fb2.zip') or path.endswith('.fbz'):
             fo = cls.openZip(fo)
             saveMethod = SaveZip(path, fo.name)
 
-        tree = etree.parse(fo)
-        fo.close()
+        if member is not None:
+            saveMethod = None
+
+        if validate and cache is not None:
+            fo = HashingReader(fo)
+
+        with metrics.stage('parse'):
+            tree = cls.parseSelective(fo) if selective else etree.parse(fo)
+            fo.close()
+
+        if selective:
+            saveMethod = None
+
+        if not validate or cache is None:
+            with metrics.stage('validate'):
+                return Book(tree, strict, saveMethod, validate)
+
+        key = cache.key(path, fo.hexdigest())
+        if cache.passed(key):
+            metrics.count('validations_cached')
+            book = Book(tree, strict, saveMethod, False)
+            book.markValid()
+            return book
+
+        with metrics.stage('validate'):
+            book = Book(tree, strict, saveMethod)
+        if book.isValid():
+            cache.add(key)
+
+        return book
 
-        return Book(tree, strict, saveMethod)
+    @classmethod
+    def fromDescription(cls, path):
+        """
+        Parses a book up to the end of its description, enough for its metadata.
+        Such a book is not validated, it has no bodies and can't be saved
+        """
+        if (path.endswith('.fb2.zip') or path.endswith('.fbz')) and inputs.split_archive_path(path)[1] is not None:
+            # ZipFile needs a seekable file
+            fo = StringIO(inputs.read(path))
+        else:
+            fo = inputs.stream(path)
+
+        try:
+            zfo = cls.openZip(fo) if path.endswith('.fb2.zip') or path.endswith('.fbz') else fo
+            with metrics.stage('parse'):
+                tree = cls.parseDescription(zfo)
+            zfo.close()
+        finally:
+            fo.close()
+
+        return Book(tree, validate=False)
 
     @classmethod
-    def fromParsed(cls, tree, strict=False):
-        return Book(tree, strict)
+    def parseDescription(cls, fo):
+        """
+        Parses a book, stopping at the end of description
+
+        :rtype: lxml.etree._ElementTree
+        """
+        context = etree.iterparse(fo, events=('end',), tag=fb2tag('description'))
+        for _event, description in context:
+            # The root of an unfinished iterparse is only reachable from its elements
+            return description.getroottree()
+
+        return etree.ElementTree(context.root)
+
+    @classmethod
+    def parseSelective(cls, fo):
+        """
+        Parses a book, dropping every binary that is not referred
+        from description or bodies right after it is parsed
+
+        :rtype: lxml.etree._ElementTree
+        """
+        refs = None
+        context = etree.iterparse(fo, events=('end',), tag=(fb2tag('body'), fb2tag('binary')))
+        for _event, e in context:
+            if e.tag == fb2tag('body'):
+                # Bodies must come before binaries, otherwise refs are incomplete
+                refs = None
+                continue
+
+            if refs is None:
+                refs = set(x.attrib[X_REF][1:] for x in ELEMENTS_WITH_REF(e))
+
+            if e.attrib.get('id') not in refs:
+                e.getparent().remove(e)
+                metrics.count('binaries_skipped')
+
+        return etree.ElementTree(context.root)
+
+    @classmethod
+    def fromParsed(cls, tree, strict=False, validate=True):
+        return Book(tree, strict, validate=validate)
 
     @classmethod
     def openZip(cls, fo):
@@ -76,6 +231,13 @@ class Book(object):
 
         raise NotAFBZException()
 
+    @classmethod
+    def loadSchema(cls):
+        """
+        Compiles the schema now, e.g. before forking workers so they share it
+        """
+        return cls.SCHEMA
+
     @classmethod
     def validate_ext(cls, tree):
         return cls.SCHEMA.validate(tree)
@@ -84,21 +246,40 @@ class Book(object):
         return self.SCHEMA.validate(self._tree)
 
     @classmethod
-    def rebuild_id(cls, oldID, globalID):
-        m = hashlib.md5()
-        m.update(globalID)
-        m.update(oldID)
+    def rebuild_id(cls, oldID, bookID, mapping):
+        newID = mapping.get(oldID)
+        if newID is None:
+            newID = mapping[oldID] = (cls.ID_PREFIX % bookID) + 'n%d' % len(mapping)
 
-        return 'id-'+m.hexdigest()
+        return newID
 
     def rebuildID(self, bookID, refs):
-        for e in ELEMENTS_WITH_ID(self._tree):
-            e.attrib['id'] = self.rebuild_id(e.attrib['id'], str(bookID))
+        """
+        Replaces ids and local references with short ids unique for bookID
+        in a single pass, adds new referenced ids to refs set
 
-        for e in ELEMENTS_WITH_REF(self._tree):
-            newRef = self.rebuild_id(e.attrib[X_REF][1:], str(bookID))
-            e.attrib[X_REF] = '#' + newRef
-            refs.append(newRef)
+        :type refs: set
+        :return: old id to new id mapping
+        :rtype: dict
+        """
+        mapping = {}
+        rewritten = 0
+        for e in ELEMENTS_WITH_ID_OR_REF(self._tree):
+            oldID = e.attrib.get('id')
+            if oldID is not None:
+                e.attrib['id'] = self.rebuild_id(oldID, bookID, mapping)
+                rewritten += 1
+
+            ref = e.attrib.get(X_REF)
+            if ref is not None and ref.startswith('#'):
+                newRef = self.rebuild_id(ref[1:], bookID, mapping)
+                e.attrib[X_REF] = '#' + newRef
+                refs.add(newRef)
+                rewritten += 1
+
+        metrics.count('ids_rewritten', rewritten)
+        self._images = None
+        return mapping
 
     def xpath(self, xpath):
         return xpath(self._tree)
@@ -145,6 +326,9 @@ class Book(object):
     def getAuthors(self):
         return AUTHORS(self._tree)
 
+    def getDescription(self):
+        return first_or_none(DESCRIPTION, self._tree)
+
     def getBodies(self):
         return BODY(self._tree)
 
@@ -157,33 +341,61 @@ class Book(object):
     def getCover(self):
         return first_or_none(COVER, self._tree)
 
-    def getImageData(self, ref):
+    def _imageBinary(self, ref):
+        """
+        Image binary ref points to, looked up in an index built on first use
+        """
         if ref is None or X_REF not in ref.attrib:
             return None
 
+        if self._images is None:
+            self._images = {}
+            for binary in self.getBinaries():
+                if binary.attrib.get('content-type', '').lower().startswith('image/'):
+                    self._images.setdefault(binary.attrib.get('id'), []).append(binary)
+
         href = ref.attrib[X_REF][1:]
-        binaries = [
-            x for x in
-            self._tree.getiterator(fb2tag('binary'))
-            if x.attrib.get('id') == href and x.attrib.get('content-type', '').lower().startswith('image/')
-        ]
+        binaries = self._images.get(href, [])
 
         if not binaries:
             raise ImageLoadException('No binaries found for #%s' % href)
         elif len(binaries) > 1:
             raise ImageLoadException('Multiple binaries found for #%s' % href)
 
-        bin = binaries[0]
-        rawImage = base64.b64decode(bin.text)
-        return rawImage
+        return binaries[0]
+
+    def getImageData(self, ref):
+        binary = self._imageBinary(ref)
+        if binary is None:
+            return None
+
+        return base64.b64decode(binary.text)
+
+    def openImage(self, ref):
+        """
+        File object reading the image ref points to,
+        base64 is decoded chunk by chunk as it is read
+
+        :rtype: fb2tools.binary.ChunkReader
+        """
+        binary = self._imageBinary(ref)
+        if binary is None:
+            return None
+
+        return ChunkReader(decode_chunks(binary.text or ''))
 
     def getBinaries(self):
         return BINARIES(self._tree)
 
     def updateBinaries(self):
+        """
+        Re-encodes binaries that are not in canonical base64
+        """
         for b in self.getBinaries():
-            s = base64.b64decode(b.text)
-            b.text = base64.b64encode(s)
+            if not is_canonical_base64(b.text):
+                b.text = base64.b64encode(base64.b64decode(b.text))
+
+        self._images = None
 
     def save(self):
         if self._strict or self._valid:
@@ -192,9 +404,9 @@ class Book(object):
         if self._saveMethod is None:
             raise RuntimeError("Cannot save book")
 
-        self._saveMethod.save(self.dump())
+        self._saveMethod.stream(self.write)
 
-    def saveAs(self, filename, zip=False, zip_internal=None):
+    def saveAs(self, filename, zip=False, zip_internal=None, zip_level=None):
         if not filename.endswith('.fb2'):
             filename += '.fb2'
 
@@ -202,11 +414,20 @@ class Book(object):
             if zip_internal is None:
                 #noinspection PyRedeclaration
                 zip_internal = 'book.fb2'
-            s = SaveZip(filename + '.zip', zip_internal)
+            s = SaveZip(filename + '.zip', zip_internal, zip_level)
         else:
             s = SaveXml(filename)
 
-        s.save(self.dump())
+        s.stream(self.write)
+
+    def write(self, fo):
+        root = self._tree.getroot() if hasattr(self._tree, 'getroot') else self._tree
+        with StreamWriter(fo, root.nsmap).document(**dict(root.attrib)) as w:
+            self._write(w, root)
+
+    def _write(self, writer, root):
+        for e in root:
+            write_element(writer, e)
 
     def dump(self):
         return etree.tostring(self._tree, xml_declaration=True, pretty_print=True, encoding='utf-8')
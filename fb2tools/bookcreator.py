@@ -1,27 +1,49 @@
 # coding=utf-8
 from bisect import bisect_right
+import copy
+from cStringIO import StringIO
 from collections import namedtuple
 import getpass
 from itertools import chain
 from datetime import datetime
-import uuid
+import json
+from lxml import etree
+import re
+import tempfile
 import time
 from . import X_REF, LIB_NAME, fb2tag
 from .stat import TitleInfo, SrcURL, SrcOCR
 from .xpath import *
 from .xml import build_element as _e
 from .book import Book
+from .binary import BinaryStore
+from .metrics import metrics
+from .spool import SectionRuns
+from .validation import skeleton, stub_description, assert_unique_ids
+from .writer import write_element, write_fragment
 
 class BookInfo(object):
     Key = namedtuple('BookInfo', 'year,sequence,title')
 
     def __init__(self, refs, year, sequence, title):
         self.key = BookInfo.Key(year, sequence, title)
-        self._refs = dict(zip(refs, refs))
+        self._refs = frozenset(refs)
 
     def referes(self, id):
         return id in self._refs
 
+    def renameRefs(self, rename):
+        self._refs = frozenset(rename(ref) for ref in self._refs)
+
+    def __getstate__(self):
+        return tuple(self.key), self._refs
+
+    def __setstate__(self, state):
+        key, self._refs = state
+        self.key = BookInfo.Key(*key)
+
+_BOOK_ID = re.compile('^' + (Book.ID_PREFIX % '(\d+)'))
+
 class BookStat(object):
     def __init__(self):
         self.titleInfo = TitleInfo(TITLE_INFO)
@@ -30,20 +52,41 @@ class BookStat(object):
         self.srcOcr = SrcOCR(SRC_OCR, False)
 
     def process(self, book, bookID):
-        self.titleInfo.add(book)
-        self.srcTitleInfo.add(book)
-        self.srcUrl.add(book)
-        self.srcOcr.add(book)
+        self.add(book)
+        return self.bookInfo(book, bookID)
 
-        refs = []
-        book.rebuildID(bookID, refs)
+    def add(self, book):
+        with metrics.stage('bookstat'):
+            self.titleInfo.add(book)
+            self.srcTitleInfo.add(book)
+            self.srcUrl.add(book)
+            self.srcOcr.add(book)
+
+    @classmethod
+    def bookInfo(cls, book, bookID):
+        refs = set()
+        with metrics.stage('rebuildID'):
+            book.rebuildID(bookID, refs)
 
         title = book.getTitle()
         sequence = None
         year = book.getYearAggressive() or float('inf')
         return BookInfo(refs, year, sequence, title)
 
+class RefIndex(object):
+    """
+    Elements with ids and local references of an inserted book,
+    collected once so finish() doesn't search the merged tree
+    """
+    def __init__(self, section, notes):
+        self.ids = SUBELEMENTS_WITH_ID(section)
+        self.refs = SUBELEMENTS_WITH_REF(section)
+        self.noteIDs = [note.attrib['id'] for note in notes]
+        self.noteRefs = list(chain(*(SUBELEMENTS_WITH_REF(note) for note in notes)))
+
 class BookCreator(object):
+    MERGE_INFO_TYPE = LIB_NAME
+
     def __init__(self, title):
         self._r = _e("FictionBook", None)
         self._description = _e('description', None)
@@ -55,25 +98,103 @@ class BookCreator(object):
 
         self._r.append(self._main)
         self._notes = []
+        self._binaries = BinaryStore()
 
         self._keys = []
+        self._bookIDs = []
+        self._index = []
+        self._ids = set()
+        self._noteIDs = set()
 
         self._title = title
 
-    def insertBook(self, key, section, notes):
-        insertPos = bisect_right(self._keys, key)
-        self._keys.insert(insertPos, key)
-        self._main.insert(insertPos + 1, section)
-        self._notes.insert(insertPos, notes)
+    @classmethod
+    def fromMerged(cls, book, stat, title=None, **kwargs):
+        """
+        Restores the state of a creator from a book it has written,
+        so more books can be inserted. Title info of book is added to stat,
+        kwargs are passed to the constructor
+
+        :type book: Book
+        :type stat: BookStat
+        """
+        info = first_or_none(MERGE_INFO, book.getDescription(), info_type=cls.MERGE_INFO_TYPE)
+        if info is None:
+            raise ValueError('Not a merged book')
+
+        books = json.loads(info.text)['books']
+        bodies = book.getBodies()
+        sections = [s for s in bodies[0] if s.tag == fb2tag('section')]
+        if len(sections) != len(books):
+            raise ValueError('Merged book has %d sections, %d expected' % (len(sections), len(books)))
+
+        notes = {}
+        for body in bodies[1:]:
+            for note in body:
+                if note.tag != fb2tag('section'):
+                    continue
+
+                m = _BOOK_ID.match(note.attrib.get('id', ''))
+                notes.setdefault(int(m.group(1)) if m else None, []).append(note)
+
+        stat.add(book)
+        creator = cls(title or book.getTitle(), **kwargs)
+        for (bookID, key), section in zip(books, sections):
+            creator.insertBook(BookInfo.Key(*key), section, notes.pop(bookID, []), bookID)
+
+        if notes:
+            raise ValueError('Notes of unknown books in merged book')
+
+        for binary in book.getBinaries():
+            creator.addBinary(binary)
+
+        return creator
+
+    @property
+    def nextBookID(self):
+        """
+        Smallest bookID not used by inserted books
+        """
+        return max([-1] + [x for x in self._bookIDs if x is not None]) + 1
+
+    def insertBook(self, key, section, notes, bookID=None):
+        with metrics.stage('insertBook'):
+            insertPos = bisect_right(self._keys, key)
+            self._keys.insert(insertPos, key)
+            self._bookIDs.insert(insertPos, bookID)
+            self._main.insert(insertPos + 1, section)
+            self._notes.insert(insertPos, notes)
+
+            index = RefIndex(section, notes)
+            self._index.insert(insertPos, index)
+            self._ids.update(e.attrib['id'] for e in index.ids)
+            self._noteIDs.update(index.noteIDs)
 
     def addBinary(self, binary):
-        self._r.append(binary)
+        with metrics.stage('binaries'):
+            kept = self._binaries.add(binary)
+
+        metrics.count('binaries_kept' if kept == binary.attrib['id'] else 'binaries_deduplicated')
+        return kept
+
+    def _resolveRef(self, e):
+        """
+        Points reference to the kept copy of a deduplicated binary
+        """
+        ref = e.attrib[X_REF][1:]
+        kept = self._binaries.resolve(ref)
+        if kept != ref:
+            e.attrib[X_REF] = '#' + kept
+
+        return kept
 
     def _addTitleInfo(self, titleInfo):
         tiData = titleInfo.write(bookTitle=self._title)
         self._description.insert(0, _e('title-info', None, *tiData))
 
     def _addDocumentInfo(self, srcUrl, srcOcr):
+        import uuid # slow to import, only needed here
+
         td = datetime.today()
         bookVersion = '%d' % time.mktime(td.timetuple())
         bookId = str(uuid.uuid4())
@@ -89,55 +210,400 @@ class BookCreator(object):
 
         self._description.append(_e('document-info', None, *diInfo))
 
-    def finish(self, stat):
+    def _addMergeInfo(self):
+        """
+        Keeps what fromMerged needs to append books later
+        """
+        books = [[bookID, list(key)] for bookID, key in zip(self._bookIDs, self._keys)]
+        self._description.append(_e('custom-info', json.dumps({'books': books}), **{'info-type': self.MERGE_INFO_TYPE}))
+
+    def _validateFragments(self, notes):
+        """
+        Validates what the merge built: description, section wrappers and notes.
+        Content of the merged books was validated on input
+        """
+        r = _e('FictionBook', None, copy.deepcopy(self._description), skeleton(self._main, 2))
+        if notes is not None:
+            r.append(skeleton(notes, 2))
+        Book.SCHEMA.assertValid(r)
+
+        assert_unique_ids(chain(
+            (e.attrib['id'] for index in self._index for e in index.ids if 'id' in e.attrib),
+            (id for index in self._index for id in index.noteIDs),
+            self._binaries.ids(),
+        ))
+
+    def _addInfo(self, stat):
         """
         :type stat: BookStat
         """
         self._addTitleInfo(stat.titleInfo)
         self._addDocumentInfo(stat.srcUrl, stat.srcOcr)
+        self._addMergeInfo()
 
-        # Clean references
-
-        notesflat = []
-        noteIDs = []
-        for pos, note in enumerate(chain(*self._notes)):
-            noteIDs.append(note.attrib['id'])
+    @classmethod
+    def _renumberNoteTitles(cls, notes, start):
+        """
+        Titles notes by their position in the merged book, counting from start
+        """
+        for pos, note in enumerate(notes, start):
             if note[0].tag == fb2tag('title'):
                 note.replace(note[0], _e('title', None, _e('p', str(pos + 1))))
-            notesflat.append(note)
 
-        notenum = 1
-        allRef = [e.attrib['id'] for e in ELEMENTS_WITH_ID(self._r)]
+    def _cleanRefs(self, index, referred, notenum):
+        """
+        Numbers references to notes from notenum, drops references to nothing
+        and adds the referred ids to referred
+
+        :type index: RefIndex
+        :return: number of the next note reference
+        """
+        for noteref in index.noteRefs:
+            self._resolveRef(noteref)
 
-        referred = []
-        for noteref in ELEMENTS_WITH_REF(self._main):
-            ref = noteref.attrib[X_REF][1:]
-            if ref in noteIDs:
+        for noteref in index.refs:
+            ref = self._resolveRef(noteref)
+            if ref in self._noteIDs:
                 noteref.text = '[%d]' % notenum
                 notenum += 1
-                referred.append(ref)
-            elif ref in allRef:
-                referred.append(ref)
+                metrics.count('notes_renumbered')
+                referred.add(ref)
+            elif ref in self._ids or ref in self._binaries:
+                referred.add(ref)
             else:
                 prev = noteref.getprevious()
                 parent = noteref.getparent()
                 # http://hustoknow.blogspot.com/2011/09/lxml-bug.html
                 if not prev:
-                    parent.text = (parent.text or '') + noteref.tail
+                    parent.text = (parent.text or '') + (noteref.tail or '')
                 else:
-                    prev.tail = (prev.tail or '') + noteref.tail
+                    prev.tail = (prev.tail or '') + (noteref.tail or '')
 
                 parent.remove(noteref)
+                metrics.count('refs_pruned')
 
-        for e in ELEMENTS_WITH_ID(self._main):
+        return notenum
+
+    @classmethod
+    def _dropUnreferencedIDs(cls, index, referred):
+        """
+        :type index: RefIndex
+        """
+        for e in index.ids:
             if e.attrib['id'] not in referred:
                 if e.tag == fb2tag('p'):
                     del e.attrib['id']
+                    metrics.count('ids_dropped')
                 else:
                     assert False, e.tag
 
-        if notesflat:
-            self._notes = _e('body', None, name="notes", *notesflat)
-            self._r.insert(2, self._notes)
+    def finish(self, stat, validate=True, fullValidation=False):
+        """
+        With validate the result is checked against the schema: by default
+        only the merge-built fragments, the whole document with fullValidation
+
+        :type stat: BookStat
+        """
+        with metrics.stage('finish'):
+            self._addInfo(stat)
+
+            notesflat = []
+            for notes in self._notes:
+                self._renumberNoteTitles(notes, len(notesflat))
+                notesflat.extend(notes)
+
+            notenum = 1
+            referred = set()
+            for index in self._index:
+                notenum = self._cleanRefs(index, referred, notenum)
+
+            for index in self._index:
+                self._dropUnreferencedIDs(index, referred)
+
+            if notesflat:
+                self._notes = _e('body', None, name="notes", *notesflat)
+                self._r.insert(2, self._notes)
+            else:
+                self._notes = None
+
+        with metrics.stage('validate_output'):
+            if not validate or fullValidation:
+                return MergedBook(self._r, self._binaries, True, validate)
+
+            self._validateFragments(self._notes)
+
+        book = MergedBook(self._r, self._binaries, True, False)
+        book.markValid()
+        return book
+
+class SpooledBookCreator(BookCreator):
+    """
+    BookCreator for collections larger than memory: sections and notes
+    of inserted books are kept serialized in SectionRuns, only ids and
+    reference targets stay in memory. finish() cleans books one by one
+    in output order and spools them to files the MergedBook streams from
+    """
+    def __init__(self, title, budget):
+        """
+        :param budget: bytes of serialized books kept in memory
+        """
+        super(SpooledBookCreator, self).__init__(title)
+        self._runs = SectionRuns(budget)
+        self._refTargets = set()
+
+    def insertBook(self, key, section, notes, bookID=None):
+        with metrics.stage('insertBook'):
+            insertPos = bisect_right(self._keys, key)
+            self._keys.insert(insertPos, key)
+            self._bookIDs.insert(insertPos, bookID)
+
+            index = RefIndex(section, notes)
+            self._ids.update(e.attrib['id'] for e in index.ids)
+            self._noteIDs.update(index.noteIDs)
+            self._refTargets.update(e.attrib[X_REF][1:] for e in index.refs)
+            self._runs.add(key, bookID, section, notes)
+
+    def _referred(self):
+        referred = set()
+        for target in self._refTargets:
+            ref = self._binaries.resolve(target)
+            if ref in self._noteIDs or ref in self._ids or ref in self._binaries:
+                referred.add(ref)
+
+        return referred
+
+    def _validatePart(self, part, description, fullValidation):
+        """
+        Validates bodies of a part of the merged book, with the description
+        or with a stub standing in for it
+
+        :param part: FictionBook element with bodies only
+        """
+        description = copy.deepcopy(self._description) if description else stub_description()
+        if not fullValidation:
+            Book.SCHEMA.assertValid(_e('FictionBook', None, description, *[skeleton(body, 2) for body in part]))
+            return
+
+        part.insert(0, description)
+        try:
+            Book.SCHEMA.assertValid(part)
+        finally:
+            part.remove(description)
+
+    def finish(self, stat, validate=True, fullValidation=False):
+        """
+        Validation checks every book with its notes separately,
+        ids are checked to be unique across the whole book
+        """
+        with metrics.stage('finish'):
+            self._addInfo(stat)
+            referred = self._referred()
+            self._refTargets = None
+
+        sections = tempfile.TemporaryFile(prefix='fb2main')
+        notesSpool = tempfile.TemporaryFile(prefix='fb2notes')
+
+        ids = []
+        first = True
+        notepos = 0
+        notenum = 1
+        for _key, bookID, section, notes, _size in self._runs:
+            with metrics.stage('finish'):
+                index = RefIndex(section, notes)
+                self._renumberNoteTitles(notes, notepos)
+                notepos += len(notes)
+                notenum = self._cleanRefs(index, set(), notenum)
+                self._dropUnreferencedIDs(index, referred)
+
+                # Same parents as in the merged tree, so serialization doesn't differ
+                part = _e('FictionBook', None, _e('body', None, copy.deepcopy(self._main[0]), section))
+                if notes:
+                    part.append(_e('body', None, name="notes", *notes))
+
+            if validate:
+                with metrics.stage('validate_output'):
+                    self._validatePart(part, first, fullValidation)
+                    ids.extend(e.attrib['id'] for e in index.ids if 'id' in e.attrib)
+                    ids.extend(index.noteIDs)
+                first = False
+
+            with metrics.stage('spool'):
+                write_fragment(sections, [section], self._r.nsmap)
+                write_fragment(notesSpool, notes, self._r.nsmap)
+
+        self._runs.close()
+
+        if validate:
+            with metrics.stage('validate_output'):
+                if first:
+                    self._validatePart(_e('FictionBook', None, copy.deepcopy(self._main)), True, fullValidation)
+                assert_unique_ids(chain(ids, self._binaries.ids()))
+
+        spools = [(self._main, sections)]
+        if notepos:
+            notesBody = _e('body', None, name="notes")
+            self._r.insert(2, notesBody)
+            spools.append((notesBody, notesSpool))
+
+        book = SpooledMergedBook(self._r, self._binaries, spools, True, False)
+        if validate:
+            book.markValid()
+        return book
+
+class _Described(object):
+    """
+    Description of an inserted book, as BookStat reads it
+    """
+    def __init__(self, description):
+        self.description = description
+
+    def xpath(self, xpath):
+        return xpath(self.description)
+
+class VolumeCreator(object):
+    """
+    Splits the merged book into volumes, in merged order: a volume is
+    finished once it has maxBooks books or adding the next book would make
+    it larger than about maxSize bytes. Books are kept serialized in
+    SectionRuns until all are inserted, then every volume is built by
+    a BookCreator of its own, with its own description, notes and binaries.
+    Only the volume being built is held in memory
+    """
+    BUDGET = 64 * 1024 * 1024
+
+    def __init__(self, title, maxBooks=None, maxSize=None, budget=BUDGET):
+        """
+        :param budget: bytes of serialized books kept in memory
+        """
+        self._title = title
+        self._maxBooks = maxBooks
+        self._maxSize = maxSize
+        self._runs = SectionRuns(budget)
+        self._binaries = BinaryStore()
+        self._bookIDs = []
+        # Ids of binaries of every book and serialized descriptions, by bookID
+        self._bookBinaries = {}
+        self._descriptions = {}
+
+    @property
+    def nextBookID(self):
+        return max([-1] + [x for x in self._bookIDs if x is not None]) + 1
+
+    def insertBook(self, key, section, notes, bookID, description):
+        """
+        :param description: description of the book, for the description of its volume
+        """
+        with metrics.stage('insertBook'):
+            self._runs.add(key, bookID, section, notes)
+            self._bookIDs.append(bookID)
+            self._bookBinaries[bookID] = []
+            self._descriptions[bookID] = etree.tostring(description)
+
+    def addBinary(self, binary):
+        """
+        Adds a binary of the book inserted last
+        """
+        bID = binary.attrib['id']
+        with metrics.stage('binaries'):
+            kept = self._binaries.add(binary)
+
+        # Counted when volumes add it again
+        self._bookBinaries[self._bookIDs[-1]].append(bID)
+        return kept
+
+    def _full(self, books, size):
+        return (self._maxBooks is not None and books > self._maxBooks) or \
+               (self._maxSize is not None and size > self._maxSize)
+
+    def volumes(self, validate=True, fullValidation=False):
+        """
+        Yields (number, MergedBook) for every volume, numbered from 1.
+        A volume is built when the previous one is taken
+        """
+        number = 0
+        volume = []
+        size = 0
+        for key, bookID, section, notes, bookSize in self._runs:
+            bookSize += sum(self._binaries.size(bID) for bID in self._bookBinaries[bookID])
+            if volume and self._full(len(volume) + 1, size + bookSize):
+                number += 1
+                yield number, self._volume(number, volume, validate, fullValidation)
+                volume, size = [], 0
+
+            volume.append((BookInfo.Key(*key), bookID, section, notes))
+            size += bookSize
+
+        if volume or not number:
+            number += 1
+            yield number, self._volume(number, volume, validate, fullValidation)
+
+        self._runs.close()
+        self._binaries.close()
+
+    def _volume(self, number, books, validate, fullValidation):
+        creator = BookCreator(u'%s. Volume %d' % (self._title, number))
+        stat = BookStat()
+        for key, bookID, section, notes in books:
+            stat.add(_Described(etree.fromstring(self._descriptions.pop(bookID))))
+            creator.insertBook(key, section, notes, bookID)
+
+            for bID in self._bookBinaries.pop(bookID):
+                binary = self._binaries.element(self._binaries.resolve(bID))
+                # Under its own id, the volume deduplicates its binaries again
+                binary.attrib['id'] = bID
+                creator.addBinary(binary)
+
+        return creator.finish(stat, validate, fullValidation)
+
+class MergedBook(Book):
+    """
+    BookCreator result: binaries are kept in a BinaryStore
+    and are only streamed out on write
+    """
+    def __init__(self, tree, binaries, strict=False, validate=True):
+        """
+        :type binaries: BinaryStore
+        """
+        super(MergedBook, self).__init__(tree, strict, validate=validate)
+        self._binaries = binaries
+
+    def getBinaries(self):
+        return [self._binaries.element(bID) for bID in self._binaries.ids()]
+
+    def _write(self, writer, root):
+        super(MergedBook, self)._write(writer, root)
+        self._binaries.write(writer)
+
+    def dump(self):
+        fo = StringIO()
+        self.write(fo)
+        return fo.getvalue()
+
+class SpooledMergedBook(MergedBook):
+    """
+    MergedBook with bodies partly kept in spool files,
+    the content of a spool is written at the end of its body
+    """
+    def __init__(self, tree, binaries, spools, strict=False, validate=True):
+        """
+        :param spools: (body element, file) pairs
+        """
+        super(SpooledMergedBook, self).__init__(tree, binaries, strict, validate)
+        self._spools = spools
+
+    def _write(self, writer, root):
+        for e in root:
+            spool = next((f for body, f in self._spools if body is e), None)
+            if spool is None:
+                write_element(writer, e)
+                continue
+
+            with writer.element(e.tag, **dict(e.attrib)):
+                for child in e:
+                    writer.write(child)
+
+                spool.seek(0)
+                for chunk in iter(lambda: spool.read(BinaryStore.CHUNK_SIZE), ''):
+                    writer.raw(chunk)
 
-        return Book.fromParsed(self._r, True)
+        self._binaries.write(writer)
@@ -0,0 +1,196 @@
+# coding=utf-8
+from collections import OrderedDict
+import cPickle as pickle
+import os
+import threading
+from . import inputs
+
+class SqliteCache(object):
+    """
+    Base for caches kept in an sqlite file.
+    Opens its connections lazily, one per process and thread,
+    so it can be passed to worker processes and shared by threads
+    """
+    SCHEMA = []
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._local = threading.local()
+
+    def __getstate__(self):
+        return {'_filename': self._filename}
+
+    def __setstate__(self, state):
+        self.__init__(state['_filename'])
+
+    def _connection(self):
+        local = self._local
+        if getattr(local, 'db', None) is None or local.pid != os.getpid():
+            import sqlite3
+
+            local.db = sqlite3.connect(self._filename, timeout=60)
+            for statement in self.SCHEMA:
+                local.db.execute(statement)
+            local.pid = os.getpid()
+
+        return local.db
+
+class PrepareCache(SqliteCache):
+    """
+    PreparedBook results keyed by input content hash and preparation options.
+    Content hashes are remembered by input path, size and mtime,
+    an input is hashed again only when those change
+    """
+    # Bump when the preparation changes the results it produces
+    VERSION = 4
+
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS prepared ('
+        'sha1 TEXT, options TEXT, data BLOB, '
+        'PRIMARY KEY (sha1, options))',
+        'CREATE TABLE IF NOT EXISTS digests ('
+        'path TEXT PRIMARY KEY, size INTEGER, mtime REAL, sha1 TEXT)',
+    ]
+
+    def key(self, path, data=None, **options):
+        """
+        :param data: content of path when it is already read
+        """
+        optionsKey = repr(sorted(options.items()) + [('version', self.VERSION)])
+        return self._digest(path, data), optionsKey
+
+    def _digest(self, path, data):
+        stat = inputs.stat(path)
+        sha1 = self._loadDigest(stat)
+        if sha1 is None:
+            sha1 = inputs.digest(path, data)
+            self._storeDigest(stat, sha1)
+
+        return sha1
+
+    def _loadDigest(self, stat):
+        row = self._connection().execute(
+            'SELECT sha1 FROM digests WHERE path = ? AND size = ? AND mtime = ?', stat
+        ).fetchone()
+
+        return None if row is None else row[0]
+
+    def _storeDigest(self, stat, sha1):
+        db = self._connection()
+        with db:
+            db.execute('INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?)', stat + (sha1,))
+
+    def get(self, key):
+        """
+        :rtype: fb2tools.prepare.PreparedBook
+        """
+        data = self._load(key)
+        return None if data is None else pickle.loads(data)
+
+    def add(self, key, prepared):
+        self._store(key, pickle.dumps(prepared, pickle.HIGHEST_PROTOCOL))
+
+    def _load(self, key):
+        row = self._connection().execute(
+            'SELECT data FROM prepared WHERE sha1 = ? AND options = ?', key
+        ).fetchone()
+
+        return None if row is None else str(row[0])
+
+    def _store(self, key, data):
+        import sqlite3
+
+        db = self._connection()
+        with db:
+            db.execute('INSERT OR REPLACE INTO prepared VALUES (?, ?, ?)', key + (sqlite3.Binary(data),))
+
+class MemoryCache(PrepareCache):
+    """
+    Least recently used prepared books, kept pickled in memory up to budget
+    bytes, in front of an optional sqlite file. Every get() unpickles a new
+    copy, so callers may change what they get. Safe to share between threads
+    """
+    def __init__(self, budget, filename=None):
+        super(MemoryCache, self).__init__(filename)
+        self._budget = budget
+        self._entries = OrderedDict()
+        self._size = 0
+        # Content hashes by input path, one entry per input ever merged
+        self._digests = {}
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def __getstate__(self):
+        # Worker processes start with empty memory of their own
+        return {'_filename': self._filename, '_budget': self._budget}
+
+    def __setstate__(self, state):
+        self.__init__(state['_budget'], state['_filename'])
+
+    def _load(self, key):
+        with self._lock:
+            data = self._entries.pop(key, None)
+            if data is not None:
+                self._entries[key] = data
+                self.hits += 1
+                return data
+
+            self.misses += 1
+
+        if self._filename is None:
+            return None
+
+        data = super(MemoryCache, self)._load(key)
+        if data is not None:
+            self._remember(key, data)
+
+        return data
+
+    def _store(self, key, data):
+        self._remember(key, data)
+        if self._filename is not None:
+            super(MemoryCache, self)._store(key, data)
+
+    def _loadDigest(self, stat):
+        with self._lock:
+            entry = self._digests.get(stat[0])
+        if entry is not None and entry[0] == stat:
+            return entry[1]
+
+        if self._filename is None:
+            return None
+
+        sha1 = super(MemoryCache, self)._loadDigest(stat)
+        if sha1 is not None:
+            with self._lock:
+                self._digests[stat[0]] = stat, sha1
+
+        return sha1
+
+    def _storeDigest(self, stat, sha1):
+        with self._lock:
+            self._digests[stat[0]] = stat, sha1
+        if self._filename is not None:
+            super(MemoryCache, self)._storeDigest(stat, sha1)
+
+    def _remember(self, key, data):
+        if len(data) > self._budget:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+
+            self._entries[key] = data
+            self._size += len(data)
+            while self._size > self._budget:
+                _key, old = self._entries.popitem(last=False)
+                self._size -= len(old)
+
+    def stats(self):
+        with self._lock:
+            return OrderedDict([
+                ('entries', len(self._entries)), ('bytes', self._size), ('budget', self._budget),
+                ('hits', self.hits), ('misses', self.misses),
+            ])
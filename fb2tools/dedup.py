@@ -0,0 +1,225 @@
+# coding=utf-8
+from contextlib import closing
+import hashlib
+from itertools import imap
+import logging
+import os
+import re
+from cStringIO import StringIO
+from zipfile import ZipFile
+from . import FB2_NSMAP, LIB_NAME, NotAFBZException, inputs
+from .book import Book
+from .metrics import metrics
+from .stat import xml_text_hash
+from .xpath import LazyXPath, first_or_none
+
+logger = logging.getLogger(LIB_NAME)
+
+DOCUMENT_VERSION = LazyXPath('//f:description/f:document-info/f:version', namespaces=FB2_NSMAP)
+DOCUMENT_DATE = LazyXPath('//f:description/f:document-info/f:date', namespaces=FB2_NSMAP)
+
+# Same content: .fb2 next to its .fb2.zip, the same file twice
+DEDUP_EXACT = 'exact'
+# Same title and authors: other releases and re-OCRed copies as well
+DEDUP_METADATA = 'metadata'
+DEDUP_MODES = [DEDUP_EXACT, DEDUP_METADATA]
+
+KEEP_FIRST = 'first'
+KEEP_LARGEST = 'largest'
+KEEP_NEWEST = 'newest'
+KEEP_POLICIES = [KEEP_FIRST, KEEP_LARGEST, KEEP_NEWEST]
+
+SAMPLE_BLOCK = 64 * 1024
+SAMPLE_BLOCKS = 4
+
+def normalize_title(title):
+    return re.sub(r'\W+', ' ', title, flags=re.UNICODE).strip().lower() if title else None
+
+def _version(text):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return None
+
+class Fingerprint(object):
+    """
+    What deduplication knows of an input book, read from its description
+    and, for exact matching, a few sampled blocks of its content
+    """
+    def __init__(self, order, path, size, title, authors, version, date, sample=None):
+        self.order = order
+        self.path = path
+        self.size = size
+        self.title = title
+        self.authors = authors
+        self.version = version
+        self.date = date
+        self.sample = sample
+
+    def key(self, mode):
+        """
+        Books with equal keys are copies of each other, None when unknown
+        """
+        if mode == DEDUP_EXACT:
+            return self.sample
+        if not self.title:
+            return None
+        return self.title, self.authors
+
+    def rank(self, policy):
+        """
+        Higher is better, ties go to the book given first
+        """
+        if policy == KEEP_LARGEST:
+            return self.size, -self.order
+        if policy == KEEP_NEWEST:
+            return self.version, self.date, -self.order
+        return -self.order
+
+def _zipped(path):
+    return path.endswith('.fb2.zip') or path.endswith('.fbz')
+
+def _zipFile(path):
+    """
+    ZipFile of a zipped book. ZipFile needs to seek,
+    zipped books inside archives are read into memory
+    """
+    member = inputs.split_archive_path(path)[1]
+    return ZipFile(StringIO(inputs.read(path)) if member is not None else path)
+
+def content_size(path):
+    """
+    Uncompressed size of a book, zipped books are not decompressed
+    """
+    if not _zipped(path):
+        return inputs.size(path)
+
+    with closing(_zipFile(path)) as z:
+        return sum(info.file_size for info in z.infolist())
+
+def _skip(fo, n):
+    while n > 0:
+        data = fo.read(min(n, SAMPLE_BLOCK))
+        if not data:
+            return
+        n -= len(data)
+
+def _sample(fo, size, seekable):
+    """
+    Reads blocks in a single pass over fo, from its start. Unless fo can
+    seek, data between blocks is read and dropped
+    """
+    m = hashlib.sha1(str(size))
+    position = 0
+    for offset in xrange(0, size, max(SAMPLE_BLOCK, size // SAMPLE_BLOCKS)):
+        if seekable:
+            fo.seek(offset)
+        else:
+            _skip(fo, offset - position)
+
+        block = fo.read(SAMPLE_BLOCK)
+        m.update(block)
+        position = offset + len(block)
+
+    return m.hexdigest()
+
+def _sizeAndSample(path):
+    """
+    :return: (content_size, sample_hash) of a book, reading it once
+    """
+    if _zipped(path):
+        with closing(_zipFile(path)) as z:
+            infos = z.infolist()
+            if len(infos) != 1:
+                raise NotAFBZException()
+
+            with closing(z.open(infos[0])) as fo:
+                return infos[0].file_size, _sample(fo, infos[0].file_size, False)
+
+    if inputs.split_archive_path(path)[1] is not None:
+        data = inputs.read(path)
+        return len(data), _sample(StringIO(data), len(data), True)
+
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        return size, _sample(f, size, True)
+
+def sample_hash(path):
+    """
+    Hash of the content size and SAMPLE_BLOCKS blocks spread over the content.
+    Plain files are read only where sampled, zipped books are decompressed
+    once up to the last block, other archive members are read whole
+    """
+    return _sizeAndSample(path)[1]
+
+def fingerprint(args):
+    """
+    :param args: (position in input, path, dedup mode)
+    :return: Fingerprint, None when the book can't be read
+    """
+    order, path, mode = args
+    try:
+        book = Book.fromDescription(path)
+        if mode == DEDUP_EXACT:
+            size, sample = _sizeAndSample(path)
+        else:
+            size, sample = content_size(path), None
+    except Exception, e:
+        # The main pass reports it
+        logger.debug('Cannot fingerprint %s: %s' % (path, e))
+        return None
+
+    return Fingerprint(
+        order, path, size,
+        normalize_title(book.getTitle()),
+        tuple(sorted(xml_text_hash(author) for author in book.getAuthors())),
+        _version(first_or_none(DOCUMENT_VERSION, book.getDescription(), lambda e: e.text)),
+        first_or_none(DOCUMENT_DATE, book.getDescription(), lambda e: e.attrib.get('value', e.text)),
+        sample,
+    )
+
+def deduplicate(paths, mode=DEDUP_METADATA, policy=KEEP_FIRST, jobs=1):
+    """
+    Drops copies of the same book from paths, keeping the best one by policy.
+    Books are compared by fingerprints read without parsing their bodies.
+    Kept books stay in input order, books that can't be read are kept
+
+    :type paths: list[str]
+    :rtype: list[str]
+    """
+    tasks = [(order, path, mode) for order, path in enumerate(paths)]
+    if jobs <= 1:
+        fingerprints = imap(fingerprint, tasks)
+        pool = None
+    else:
+        from multiprocessing import Pool
+
+        pool = Pool(jobs)
+        fingerprints = pool.imap(fingerprint, tasks, chunksize=16)
+
+    best = {}
+    duplicates = set()
+    try:
+        with metrics.stage('dedup'):
+            for fp in fingerprints:
+                key = fp.key(mode) if fp is not None else None
+                if key is None:
+                    continue
+
+                kept = best.get(key)
+                if kept is None:
+                    best[key] = fp
+                    continue
+
+                if fp.rank(policy) > kept.rank(policy):
+                    best[key], fp = fp, kept
+
+                logger.info('Skipping %s: duplicate of %s' % (fp.path, best[key].path))
+                duplicates.add(fp.order)
+                metrics.count('duplicates_skipped')
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    return [path for order, path in enumerate(paths) if order not in duplicates]
@@ -0,0 +1,215 @@
+# coding=utf-8
+import base64
+from collections import OrderedDict
+from cStringIO import StringIO
+import cPickle as pickle
+import hashlib
+import logging
+import threading
+from . import LIB_NAME
+from .cache import SqliteCache
+from .metrics import metrics
+
+logger = logging.getLogger(LIB_NAME)
+
+CONTENT_TYPES = {'jpeg': 'image/jpeg', 'png': 'image/png'}
+IMAGE_FORMATS = sorted(CONTENT_TYPES)
+
+def available():
+    """
+    Recompression needs PIL (Pillow), an optional dependency
+    """
+    try:
+        import PIL.Image
+    except ImportError:
+        return False
+
+    return True
+
+class ImageOptions(object):
+    def __init__(self, maxSize=None, format=None, quality=85):
+        """
+        :param maxSize: longest side in pixels, larger images are downscaled
+        :param format: 'jpeg' or 'png', None keeps the format of every image
+        :param quality: JPEG quality
+        """
+        self.maxSize = maxSize
+        self.format = format
+        self.quality = quality
+
+    def key(self):
+        return repr((self.maxSize, self.format, self.quality))
+
+def recompress(data, options):
+    """
+    Downscales and re-encodes an image
+
+    :type options: ImageOptions
+    :return: (data, content type), None when the image is better left as is
+    """
+    from PIL import Image
+
+    try:
+        image = Image.open(StringIO(data))
+        image.load()
+    except (IOError, ValueError, SyntaxError), e:
+        logger.debug('Not recompressing image: %s' % e)
+        return None
+
+    resized = False
+    if options.maxSize and max(image.size) > options.maxSize:
+        image.thumbnail((options.maxSize, options.maxSize), Image.ANTIALIAS)
+        resized = True
+
+    format = options.format or {'JPEG': 'jpeg'}.get(image.format, 'png')
+    # JPEG has no transparency
+    if format == 'jpeg' and (image.mode in ('RGBA', 'LA') or 'transparency' in image.info):
+        format = 'png'
+
+    out = StringIO()
+    if format == 'jpeg':
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        image.save(out, 'JPEG', quality=options.quality, optimize=True)
+    else:
+        image.save(out, 'PNG', optimize=True)
+
+    result = out.getvalue()
+    if not resized and len(result) >= len(data):
+        return None
+
+    return result, CONTENT_TYPES[format]
+
+class _RecentResults(object):
+    """
+    Least recently used recompression results, up to budget bytes of
+    image data. Safe to share between threads
+    """
+    # Counted for every entry, so results that keep images as they are count too
+    ENTRY_SIZE = 128
+
+    def __init__(self, budget):
+        self._budget = budget
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def _sizeOf(cls, result):
+        return cls.ENTRY_SIZE + (len(result[0]) if result is not None else 0)
+
+    def get(self, key):
+        """
+        :return: (found, result of recompress)
+        """
+        with self._lock:
+            if key not in self._entries:
+                return False, None
+
+            result = self._entries[key] = self._entries.pop(key)
+            return True, result
+
+    def add(self, key, result):
+        size = self._sizeOf(result)
+        if size > self._budget:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._sizeOf(self._entries.pop(key))
+
+            self._entries[key] = result
+            self._size += size
+            while self._size > self._budget:
+                _key, old = self._entries.popitem(last=False)
+                self._size -= self._sizeOf(old)
+
+# Results of images recompressed by this process, every worker has its own
+_recent = _RecentResults(16 * 1024 * 1024)
+
+class ImageCache(SqliteCache):
+    """
+    Recompression results keyed by image content hash and options
+    """
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS images ('
+        'sha1 TEXT, options TEXT, data BLOB, '
+        'PRIMARY KEY (sha1, options))'
+    ]
+
+    def get(self, key):
+        """
+        :return: (found, result of recompress)
+        """
+        row = self._connection().execute(
+            'SELECT data FROM images WHERE sha1 = ? AND options = ?', key
+        ).fetchone()
+
+        if row is None:
+            return False, None
+
+        return True, pickle.loads(str(row[0]))
+
+    def add(self, key, result):
+        import sqlite3
+
+        data = sqlite3.Binary(pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+        db = self._connection()
+        with db:
+            db.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?)', key + (data,))
+
+class ImageRecompressor(object):
+    """
+    Recompresses image binaries of prepared books. Used by prepareBook,
+    so images are processed by the workers preparing the books.
+    Images seen recently by the process are processed once,
+    with a cache every distinct image is processed once at all
+    """
+    def __init__(self, options, cache=None):
+        """
+        :type options: ImageOptions
+        :type cache: ImageCache
+        """
+        self._options = options
+        self._cache = cache
+
+    def _recompress(self, data):
+        key = hashlib.sha1(data).hexdigest(), self._options.key()
+        found, result = _recent.get(key)
+        if found:
+            return result
+
+        if self._cache is not None:
+            found, result = self._cache.get(key)
+            if found:
+                metrics.count('images_cached')
+
+        if not found:
+            result = recompress(data, self._options)
+            if self._cache is not None:
+                self._cache.add(key, result)
+
+        _recent.add(key, result)
+        return result
+
+    def process(self, book):
+        """
+        Replaces image binaries of book
+
+        :type book: fb2tools.prepare.PreparedBook
+        """
+        with metrics.stage('images'):
+            for binary in book.binaries:
+                if not binary.attrib.get('content-type', '').lower().startswith('image/'):
+                    continue
+
+                result = self._recompress(base64.b64decode(binary.text or ''))
+                if result is None:
+                    continue
+
+                data, contentType = result
+                binary.text = base64.b64encode(data)
+                binary.attrib['content-type'] = contentType
+                metrics.count('images_recompressed')
+
+        return book
@@ -0,0 +1,279 @@
+# coding=utf-8
+from collections import OrderedDict
+from fnmatch import fnmatch
+import glob
+import hashlib
+import os
+import sys
+import threading
+from zipfile import ZipFile, BadZipfile
+from .metrics import metrics
+
+ARCHIVE_SEPARATOR = '!'
+
+# Open archives by path: (pid, mtime, size, ZipFile), least recently used first
+_archives = OrderedDict()
+_archivesLock = threading.Lock()
+# Archives kept open at once
+OPEN_ARCHIVES = 16
+
+def split_archive_path(path):
+    """
+    Splits archive.zip!member into ('archive.zip', 'member'),
+    other paths are returned as (path, None)
+    """
+    archive, sep, member = path.partition(ARCHIVE_SEPARATOR)
+    if sep and member and archive.lower().endswith('.zip'):
+        return archive, member
+
+    return path, None
+
+def _archive(path, st=None):
+    """
+    ZipFile for path, kept open by the process while the archive stays as it
+    is. An archive with a new size or mtime is opened again, its central
+    directory is read anew
+
+    :param st: os.stat(path) when it is already known
+    """
+    if st is None:
+        st = os.stat(path)
+    version = os.getpid(), st.st_mtime, st.st_size
+
+    with _archivesLock:
+        entry = _archives.pop(path, None)
+        if entry is not None and entry[:3] != version:
+            # Streams opened by the old ZipFile read files of their own
+            entry[3].close()
+            entry = None
+
+        if entry is None:
+            entry = version + (ZipFile(path),)
+            while len(_archives) >= OPEN_ARCHIVES:
+                _path, old = _archives.popitem(last=False)
+                old[3].close()
+
+        _archives[path] = entry
+        return entry[3]
+
+def expand(patterns):
+    """
+    Yields input paths for glob patterns. archive.zip!pattern yields
+    archive members matching pattern, in archive order
+    """
+    for pattern in patterns:
+        archivePattern, memberPattern = split_archive_path(pattern)
+        if memberPattern is None:
+            for path in glob.iglob(pattern):
+                yield path
+            continue
+
+        for archive in glob.iglob(archivePattern):
+            try:
+                members = _archive(archive).infolist()
+            except (OSError, IOError, BadZipfile):
+                yield archive + ARCHIVE_SEPARATOR + memberPattern
+                continue
+
+            for member in members:
+                if not member.filename.endswith('/') and fnmatch(member.filename, memberPattern):
+                    yield archive + ARCHIVE_SEPARATOR + member.filename
+
+def isfile(path):
+    archive, member = split_archive_path(path)
+    if member is None:
+        return os.path.isfile(path)
+
+    try:
+        _archive(archive).getinfo(member)
+    except (OSError, IOError, BadZipfile, KeyError):
+        return False
+
+    return True
+
+def read(path):
+    """
+    Whole content of a file or an archive member
+    """
+    archive, member = split_archive_path(path)
+    if member is None:
+        with open(path, 'rb') as f:
+            return f.read()
+
+    z = _archive(archive)
+    # Members of one archive share its file object
+    with _archivesLock:
+        return z.read(member)
+
+def stream(path):
+    """
+    File object reading a file or an archive member from the start,
+    for readers that may stop early. Members of one archive must not
+    be streamed by several threads at once
+    """
+    archive, member = split_archive_path(path)
+    if member is None:
+        return open(path, 'rb')
+
+    return _archive(archive).open(member)
+
+def stat(path):
+    """
+    (path, size, mtime) identifying the current state of an input
+    """
+    archive, member = split_archive_path(path)
+    st = os.stat(archive)
+    if member is None:
+        return os.path.abspath(path), st.st_size, st.st_mtime
+
+    info = _archive(archive, st).getinfo(member)
+    return os.path.abspath(archive) + ARCHIVE_SEPARATOR + member, info.file_size, st.st_mtime
+
+def size(path):
+    """
+    Size of an input in bytes, uncompressed size for archive members
+    """
+    archive, member = split_archive_path(path)
+    try:
+        if member is None:
+            return os.path.getsize(path)
+        return _archive(archive).getinfo(member).file_size
+    except (OSError, IOError, BadZipfile, KeyError):
+        return 0
+
+def digest(path, data=None, chunk_size=1024 * 1024):
+    m = hashlib.sha1()
+    if data is not None:
+        m.update(data)
+    elif split_archive_path(path)[1] is not None:
+        m.update(read(path))
+    else:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), ''):
+                m.update(chunk)
+
+    return m.hexdigest()
+
+class ReadAhead(object):
+    """
+    Iterates over (path, data) for paths, in order. Up to depth threads read
+    inputs ahead, holding at most budget bytes read and not yet taken, so
+    opening and reading, slow on network storage, overlap with parsing.
+    Data is None for inputs larger than budget and for inputs that are not
+    files, those are read when parsed. An error reading an input is raised
+    when iteration gets to it, as reading it then would have
+    """
+    DEPTH = 4
+    BUDGET = 64 * 1024 * 1024
+
+    def __init__(self, paths, depth=DEPTH, budget=BUDGET):
+        self._paths = enumerate(paths)
+        self._depth = max(depth, 1)
+        self._budget = budget
+        self._condition = threading.Condition()
+        # Reads done, by input position
+        self._ready = {}
+        self._held = 0
+        self._next = 0
+        self._taken = 0
+        self._count = None
+        self._stopped = False
+        self._threads = [
+            threading.Thread(target=self._run, name='ReadAhead-%d' % n) for n in xrange(self._depth)
+        ]
+        for thread in self._threads:
+            thread.daemon = True
+
+    def _take(self):
+        """
+        Next input to read, None when there is none or iteration stopped
+        """
+        with self._condition:
+            while not self._stopped and self._count is None and self._taken - self._next >= self._depth:
+                self._condition.wait()
+            if self._stopped or self._count is not None:
+                return None
+
+            try:
+                item = self._paths.next()
+            except StopIteration:
+                self._count = self._taken
+                self._condition.notify_all()
+                return None
+
+            self._taken += 1
+            return item
+
+    def _reserve(self, position, size):
+        """
+        Waits for room for size bytes, the input taken next always gets it.
+        False when the input is not to be read ahead
+        """
+        with self._condition:
+            if size > self._budget:
+                return False
+
+            while not self._stopped and position != self._next and self._held + size > self._budget:
+                self._condition.wait()
+            if self._stopped:
+                return False
+
+            self._held += size
+            return True
+
+    def _read(self, position, path):
+        """
+        :return: (data, bytes reserved for it, sys.exc_info() of a failed read)
+        """
+        reserved = 0
+        try:
+            if isfile(path):
+                reserved = size(path)
+                if self._reserve(position, reserved):
+                    return read(path), reserved, None
+                reserved = 0
+        except Exception:
+            return None, reserved, sys.exc_info()
+
+        return None, reserved, None
+
+    def _run(self):
+        while True:
+            item = self._take()
+            if item is None:
+                return
+
+            position, path = item
+            ready = (path,) + self._read(position, path)
+            with self._condition:
+                self._ready[position] = ready
+                self._condition.notify_all()
+
+    def __iter__(self):
+        for thread in self._threads:
+            thread.start()
+
+        try:
+            while True:
+                with self._condition:
+                    with metrics.stage('read_wait'):
+                        while self._next not in self._ready and self._next != self._count:
+                            self._condition.wait()
+
+                    if self._next == self._count:
+                        return
+
+                    path, data, reserved, error = self._ready.pop(self._next)
+                    self._next += 1
+                    self._held -= reserved
+                    self._condition.notify_all()
+
+                if error is not None:
+                    metrics.count('read_ahead_errors')
+                    raise error[0], error[1], error[2]
+
+                yield path, data
+        finally:
+            with self._condition:
+                self._stopped = True
+                self._condition.notify_all()
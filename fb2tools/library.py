@@ -0,0 +1,203 @@
+# coding=utf-8
+from fnmatch import fnmatch
+from itertools import imap
+import logging
+import os
+from . import LIB_NAME, inputs
+from .book import Book
+from .cache import SqliteCache
+from .formatter import SimpleAuthorFormatter
+from .stat import TitleInfo
+from .xpath import TITLE_INFO
+
+logger = logging.getLogger(LIB_NAME)
+
+BOOK_SUFFIXES = ('.fb2', '.fb2.zip', '.fbz')
+
+COLUMNS = [
+    'path', 'size', 'mtime', 'title', 'authors', 'year',
+    'sequence', 'sequence_number', 'lang', 'genres', 'error',
+]
+
+# Separates values of authors and genres columns
+LIST_SEPARATOR = '; '
+
+def is_book(path):
+    return path.lower().endswith(BOOK_SUFFIXES)
+
+def _isArchive(path):
+    return path.lower().endswith('.zip') and not is_book(path)
+
+def _members(archive):
+    return (path for path in inputs.expand([archive + inputs.ARCHIVE_SEPARATOR + '*']) if is_book(path))
+
+def find_books(roots):
+    """
+    Yields books under roots: directories are walked, zip archives
+    other than .fb2.zip are searched for books, other roots are
+    glob patterns as fb2merge takes them
+    """
+    for root in inputs.expand(roots):
+        if os.path.isdir(root):
+            for directory, dirnames, filenames in os.walk(root):
+                dirnames.sort()
+                for name in sorted(filenames):
+                    path = os.path.join(directory, name)
+                    if is_book(path):
+                        yield path
+                    elif _isArchive(path):
+                        for member in _members(path):
+                            yield member
+        elif _isArchive(root):
+            for member in _members(root):
+                yield member
+        else:
+            yield root
+
+def _join(values):
+    return LIST_SEPARATOR.join(v for v in values if v) or None
+
+def describe(book):
+    """
+    Metadata of a book parsed with Book.fromDescription
+
+    :type book: Book
+    :return: values of COLUMNS from title to genres
+    """
+    titleInfo = TitleInfo(TITLE_INFO, False)
+    titleInfo.add(book)
+
+    formatter = SimpleAuthorFormatter(False)
+    sequence = titleInfo.sequences[0].attrib if titleInfo.sequences else {}
+    number = sequence.get('number')
+    lang = max(titleInfo.langs.iteritems(), key=lambda x: x[1])[0] if titleInfo.langs else None
+
+    return (
+        book.getTitle(),
+        _join(formatter.format(author) for author in book.getAuthors()),
+        book.getYearAggressive(),
+        sequence.get('name'),
+        int(number) if number and number.isdigit() else None,
+        lang,
+        _join(sorted(titleInfo.genres)),
+    )
+
+def scan(args):
+    """
+    Reads metadata of one book
+
+    :param args: (path, key, size, mtime) of the book, as inputs.stat gives key, size and mtime
+    :return: index row, error column set when the book can't be read
+    """
+    path, key, size, mtime = args
+    try:
+        return (key, size, mtime) + describe(Book.fromDescription(path)) + (None,)
+    except Exception, e:
+        logger.debug('Cannot scan %s: %s' % (path, e))
+        return (key, size, mtime) + (None,) * 7 + (str(e) or e.__class__.__name__,)
+
+class LibraryIndex(SqliteCache):
+    """
+    Metadata of library books, keyed by absolute path.
+    A book is scanned again when its size or mtime change
+    """
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS books ('
+        'path TEXT PRIMARY KEY, size INTEGER, mtime REAL, '
+        'title TEXT, authors TEXT, year INTEGER, sequence TEXT, sequence_number INTEGER, '
+        'lang TEXT, genres TEXT, error TEXT)',
+        'CREATE INDEX IF NOT EXISTS books_title ON books (title)',
+        'CREATE INDEX IF NOT EXISTS books_authors ON books (authors)',
+    ]
+
+    def _connection(self):
+        db = super(LibraryIndex, self)._connection()
+        # Paths are byte strings, not always utf-8
+        db.text_factory = str
+        return db
+
+    def known(self):
+        """
+        :return: {path: (size, mtime)}
+        """
+        c = self._connection().execute('SELECT path, size, mtime FROM books')
+        return dict((path, (size, mtime)) for path, size, mtime in c)
+
+    def update(self, rows):
+        db = self._connection()
+        with db:
+            db.executemany('INSERT OR REPLACE INTO books VALUES (%s)' % ', '.join('?' * len(COLUMNS)), rows)
+
+    def remove(self, paths):
+        db = self._connection()
+        with db:
+            db.executemany('DELETE FROM books WHERE path = ?', ((path,) for path in paths))
+
+def _covers(root, path):
+    """
+    True when find_books(root) would yield path if it existed:
+    the root pattern matches path, its archive or one of its directories
+    """
+    rootArchive, rootMember = inputs.split_archive_path(root)
+    archive, member = inputs.split_archive_path(path)
+    if rootMember is not None:
+        return member is not None and _covers(rootArchive, archive) and fnmatch(member, rootMember)
+
+    pattern = os.path.abspath(rootArchive).rstrip(os.sep).split(os.sep)
+    parts = archive.split(os.sep)
+    return len(parts) >= len(pattern) and all(fnmatch(p, q) for p, q in zip(parts, pattern))
+
+def index_library(roots, index, jobs=1, batch=1000):
+    """
+    Brings index up to date with books under roots, scanning new
+    and changed books in jobs processes. Rows of books roots cover,
+    as directories, archives, files or glob patterns, that are gone
+    are removed
+
+    :type index: LibraryIndex
+    :return: (scanned, unchanged, removed, failed) numbers of books
+    """
+    known = index.known()
+    seen = set()
+    tasks = []
+    for path in find_books(roots):
+        try:
+            key, size, mtime = inputs.stat(path)
+        except (OSError, IOError, KeyError), e:
+            logger.warning('Skipping %s: %s' % (path, e))
+            continue
+
+        seen.add(key)
+        if known.get(key) != (size, mtime):
+            tasks.append((path, key, size, mtime))
+
+    removed = [path for path in known if path not in seen and any(_covers(root, path) for root in roots)]
+    index.remove(removed)
+
+    if jobs <= 1:
+        rows = imap(scan, tasks)
+        pool = None
+    else:
+        from multiprocessing import Pool
+
+        pool = Pool(jobs)
+        # Neighbour members share an archive, chunks keep them in one worker
+        rows = pool.imap_unordered(scan, tasks, chunksize=64)
+
+    failed = 0
+    pending = []
+    try:
+        for n, row in enumerate(rows, 1):
+            failed += row[-1] is not None
+            pending.append(row)
+            if len(pending) >= batch:
+                index.update(pending)
+                pending = []
+                logger.info('Scanned %d of %d books' % (n, len(tasks)))
+        index.update(pending)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    return len(tasks), len(seen) - len(tasks), len(removed), failed
@@ -0,0 +1,155 @@
+# coding=utf-8
+from collections import OrderedDict
+from contextlib import contextmanager
+import os
+import resource
+import time
+
+def _cpu():
+    t = os.times()
+    return t[0] + t[1]
+
+_PAGE_KB = os.sysconf('SC_PAGE_SIZE') // 1024 if hasattr(os, 'sysconf') else 4
+
+def _rss():
+    """
+    Current resident size in KB, peak resident size where /proc is missing
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_KB
+    except (IOError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _maxrss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class _Record(object):
+    """
+    Stage measurements and counters of a run or of one input book
+    """
+    def __init__(self, **info):
+        self.info = OrderedDict(sorted(info.items()))
+        self.stages = OrderedDict()
+        self.counters = {}
+
+    def addStage(self, name, wall, cpu, rss, maxrss, calls=1):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = OrderedDict(
+                [('calls', 0), ('wall', 0.0), ('cpu', 0.0), ('rss_delta_kb', 0), ('maxrss_kb', 0)]
+            )
+
+        stage['calls'] += calls
+        stage['wall'] += wall
+        stage['cpu'] += cpu
+        stage['rss_delta_kb'] += rss
+        stage['maxrss_kb'] = max(stage['maxrss_kb'], maxrss)
+
+    def count(self, name, n):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def update(self, other):
+        """
+        :type other: _Record
+        """
+        self.info.update(other.info)
+        for name, s in other.stages.iteritems():
+            self.addStage(name, s['wall'], s['cpu'], s['rss_delta_kb'], s['maxrss_kb'], s['calls'])
+        for name, n in other.counters.iteritems():
+            self.count(name, n)
+
+    def asDict(self):
+        d = OrderedDict(self.info)
+        d['stages'] = self.stages
+        d['counters'] = OrderedDict(sorted(self.counters.items()))
+        return d
+
+class Metrics(object):
+    """
+    Wall time, CPU time and memory of merge stages, and event counters,
+    for the whole run and per input book. Does nothing until enabled.
+
+    Measurements go to the book set with book(), to the run otherwise.
+    Worker processes detach() records of their books,
+    the main process attach()es them back
+    """
+    def __init__(self):
+        self.enabled = False
+        self._run = _Record()
+        self._books = OrderedDict()
+        self._current = None
+        self._start = None
+
+    def enable(self):
+        self.enabled = True
+        self._start = time.time(), _cpu()
+
+    def _record(self):
+        return self._run if self._current is None else self._current
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        wall, cpu, rss = time.time(), _cpu(), _rss()
+        try:
+            yield
+        finally:
+            self._record().addStage(name, time.time() - wall, _cpu() - cpu, _rss() - rss, _maxrss())
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self._record().count(name, n)
+
+    @contextmanager
+    def book(self, bookID, path):
+        if not self.enabled:
+            yield
+            return
+
+        record = self._books.get(bookID)
+        if record is None:
+            record = self._books[bookID] = _Record(book_id=bookID, path=path)
+
+        previous, self._current = self._current, record
+        try:
+            yield
+        finally:
+            self._current = previous
+
+    def detach(self, bookID):
+        """
+        Removes the record of a book and returns it, None when disabled
+        """
+        return self._books.pop(bookID, None)
+
+    def attach(self, bookID, record):
+        if record is None or not self.enabled:
+            return
+
+        if bookID in self._books:
+            self._books[bookID].update(record)
+        else:
+            self._books[bookID] = record
+
+    def report(self):
+        total = _Record()
+        total.update(self._run)
+        for record in self._books.itervalues():
+            total.update(record)
+
+        report = OrderedDict()
+        if self._start is not None:
+            report['wall'] = time.time() - self._start[0]
+            report['cpu'] = _cpu() - self._start[1]
+        report['maxrss_kb'] = _maxrss()
+        report['stages'] = total.stages
+        report['counters'] = OrderedDict(sorted(total.counters.items()))
+        report['run'] = self._run.asDict()
+        report['books'] = [record.asDict() for record in self._books.itervalues()]
+        return report
+
+metrics = Metrics()
@@ -0,0 +1,216 @@
+# coding=utf-8
+import logging
+from itertools import imap
+from lxml import etree
+from . import LIB_NAME, NotAFBZException, X_REF, fb2tag, inputs
+from .book import Book
+from .inputs import ReadAhead
+from .metrics import metrics
+from .bookcreator import BookStat
+from .section import Section
+from .xml import build_element as _e
+from .xpath import SUBELEMENTS_WITH_ID_OR_REF
+
+logger = logging.getLogger(LIB_NAME)
+
+class PreparedBook(object):
+    """
+    Per-book result of the merge: everything BookCreator and BookStat need,
+    detached from the source document so it can cross a process boundary
+    """
+    def __init__(self, bookID, path, info, description, section, notes, binaries):
+        """
+        :type info: fb2tools.bookcreator.BookInfo
+        """
+        self.bookID = bookID
+        self.path = path
+        self.info = info
+        self.description = description
+        self.section = section
+        self.notes = notes
+        self.binaries = binaries
+        # fb2tools.metrics record of preparing the book
+        self.metrics = None
+
+    def xpath(self, xpath):
+        return xpath(self.description)
+
+    def renumber(self, bookID):
+        """
+        Moves ids Book.rebuildID made for another position in the input to bookID
+        """
+        if bookID == self.bookID:
+            return
+
+        old, new = Book.ID_PREFIX % self.bookID, Book.ID_PREFIX % bookID
+        rename = lambda x: new + x[len(old):] if x.startswith(old) else x
+
+        for root in [self.description, self.section] + self.notes + self.binaries:
+            for e in SUBELEMENTS_WITH_ID_OR_REF(root):
+                if 'id' in e.attrib:
+                    e.attrib['id'] = rename(e.attrib['id'])
+                ref = e.attrib.get(X_REF)
+                if ref is not None and ref.startswith('#'):
+                    e.attrib[X_REF] = '#' + rename(ref[1:])
+
+        self.info.renameRefs(rename)
+        self.bookID = bookID
+
+    def __getstate__(self):
+        # Notes and binaries are moved under wrapper elements, the object stays usable
+        state = self.__dict__.copy()
+        state['description'] = etree.tostring(self.description, with_tail=False)
+        state['section'] = etree.tostring(self.section, with_tail=False)
+        # Wrapping rebinds namespace prefixes the same way BookCreator does,
+        # so pickled and in-process results serialize identically
+        state['notes'] = etree.tostring(_e('body', None, *self.notes))
+        state['binaries'] = etree.tostring(_e('FictionBook', None, *self.binaries))
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.description = etree.fromstring(self.description)
+        self.section = etree.fromstring(self.section)
+        self.notes = list(etree.fromstring(self.notes))
+        self.binaries = list(etree.fromstring(self.binaries))
+
+def prepareBook(bookID, path, validate=True, validationCache=None, cache=None, data=None, images=None):
+    """
+    Parses, validates and rebuilds a single book,
+    or loads the result of an earlier run from cache
+
+    :type validationCache: fb2tools.validation.ValidationCache
+    :type cache: fb2tools.cache.PrepareCache
+    :param data: content of path when it is already read
+    :param images: recompresses image binaries of the book, cache keeps them as they were
+    :type images: fb2tools.images.ImageRecompressor
+    :rtype: PreparedBook
+    """
+    with metrics.book(bookID, path):
+        prepared = _prepareCached(bookID, path, validate, validationCache, cache, data)
+        if prepared is not None and images is not None:
+            images.process(prepared)
+
+    record = metrics.detach(bookID)
+    if prepared is not None:
+        prepared.metrics = record
+
+    return prepared
+
+def _prepareCached(bookID, path, validate, validationCache, cache, data):
+    if not inputs.isfile(path):
+        logger.info('Skipping %s: not a file' % path)
+        return None
+
+    if cache is None:
+        return _prepareBook(bookID, path, validate, validationCache, data)
+
+    with metrics.stage('cache'):
+        key = cache.key(path, data, validate=validate)
+        prepared = cache.get(key)
+    if prepared is not None:
+        logger.debug('Cached %s' % path)
+        metrics.count('books_cached')
+        prepared.path = path
+        prepared.renumber(bookID)
+        return prepared
+
+    prepared = _prepareBook(bookID, path, validate, validationCache, data)
+    if prepared is not None:
+        with metrics.stage('cache'):
+            cache.add(key, prepared)
+
+    return prepared
+
+def _prepareBook(bookID, path, validate, validationCache, data):
+    try:
+        book = Book.fromFile(path, True, validate, validationCache, selective=True, data=data)
+    except NotAFBZException:
+        logger.warning('Not a valid fbz file: ' + path)
+        return None
+
+    bodies = book.getBodies()
+
+    if len(bodies) > 2 or len(bodies) == 0:
+        logger.error("Book %s has %d bodies" % (path, len(bodies)))
+        return None
+
+    if len(bodies) == 2 and bodies[1].attrib.get('name') != 'notes':
+        logger.error("Book %s second body bodies is not [notes]" % path)
+        return None
+
+    bookinfo = BookStat.bookInfo(book, bookID)
+    description = book.getDescription()
+
+    with metrics.stage('rebuild_section'):
+        sp = Section(bodies[0])
+        new_section = sp.rebuild_section(
+            annotation=book.getAnnotation(),
+            cover=book.getCover(),
+            epigraphs=book.getEpigraphs(),
+            title=book.getTitle(),
+        )
+
+    booknotes = []
+    if len(bodies) > 1:
+        for _pos, noteSection in enumerate(bodies[1]):
+            if not noteSection.tag == fb2tag('section'):
+                if _pos or not noteSection.tag == fb2tag('title') :
+                    logger.warn("Wrong note: %s in %s" % (noteSection.tag, path))
+                continue
+
+            booknotes.append(noteSection)
+
+    binaries = []
+    for binary in book.getBinaries():
+        bID = binary.attrib['id']
+        if not bookinfo.referes(bID):
+            logger.info('Skipping binary %s' % bID)
+            metrics.count('binaries_skipped')
+            continue
+
+        binaries.append(binary)
+
+    return PreparedBook(bookID, path, bookinfo, description, new_section, booknotes, binaries)
+
+def _prepareTask(args):
+    bookID, path, data, options = args
+    return prepareBook(bookID, path, data=data, **options)
+
+def prepareBooks(paths, jobs=1, start=0, readAhead=ReadAhead.DEPTH, readAheadBudget=ReadAhead.BUDGET, **options):
+    """
+    Yields PreparedBook for every usable path, in input order.
+    Books are numbered from start.
+    With jobs > 1 books are prepared in a process pool,
+    otherwise up to readAhead inputs are read ahead, see ReadAhead.
+    Options are passed to prepareBook
+
+    :type jobs: int
+    """
+    if jobs <= 1 and readAhead > 0:
+        # Workers of a pool read their inputs themselves
+        paths = ReadAhead(paths, readAhead, readAheadBudget)
+    else:
+        paths = ((path, None) for path in paths)
+
+    tasks = ((bookID, path, data, options) for bookID, (path, data) in enumerate(paths, start))
+    if jobs <= 1:
+        results = imap(_prepareTask, tasks)
+        pool = None
+    else:
+        # multiprocessing is slow to import and most tools never need it
+        from multiprocessing import Pool
+
+        if options.get('validate', True):
+            Book.loadSchema()
+        pool = Pool(jobs)
+        results = pool.imap(_prepareTask, tasks)
+
+    try:
+        for prepared in results:
+            if prepared is not None:
+                yield prepared
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
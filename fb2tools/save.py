@@ -1,5 +1,9 @@
 # coding=utf-8
-from zipfile import ZipFile, ZIP_DEFLATED
+import binascii
+from contextlib import contextmanager
+import os
+import zlib
+from zipstream import ZipStream
 
 class Saver(object):
     def __init__(self, filename):
@@ -8,17 +12,55 @@ class Saver(object):
     def save(self, xml):
         raise NotImplementedError()
 
+    def stream(self, write):
+        """
+        Calls write(fo) with a file object for the output document
+        """
+        raise NotImplementedError()
+
+    @contextmanager
+    def _replacing(self):
+        """
+        File object of a temporary file next to the output, renamed over it
+        when the block succeeds and removed when it fails, so the output
+        is never left half written. A replaced file keeps its mode
+        """
+        temp = '%s.%s.tmp' % (self._f, binascii.hexlify(os.urandom(4)))
+        f = os.fdopen(os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666), 'wb')
+        try:
+            with f:
+                yield f
+            if os.path.exists(self._f):
+                os.chmod(temp, os.stat(self._f).st_mode & 07777)
+            os.rename(temp, self._f)
+        except:
+            try:
+                os.unlink(temp)
+            except OSError:
+                pass
+            raise
+
 class SaveXml(Saver):
     def save(self, xml):
-        with open(self._f, 'w') as f:
-            f.write(xml)
+        self.stream(lambda fo: fo.write(xml))
+
+    def stream(self, write):
+        with self._replacing() as f:
+            write(f)
 
 class SaveZip(Saver):
-    def __init__(self, filename, zip_filename):
+    def __init__(self, filename, zip_filename, level=None):
+        """
+        :param level: zlib compression level 0-9, 0 stores the document
+        """
         super(SaveZip, self).__init__(filename)
         self._z = zip_filename
+        self._level = zlib.Z_DEFAULT_COMPRESSION if level is None else level
 
     def save(self, xml):
-        z = ZipFile(self._f, 'w', ZIP_DEFLATED)
-        z.writestr(self._z, xml)
-        z.close()
+        self.stream(lambda fo: fo.write(xml))
+
+    def stream(self, write):
+        with self._replacing() as f:
+            with ZipStream(f, self._z, self._level) as z:
+                write(z)
@@ -0,0 +1,324 @@
+# coding=utf-8
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import OrderedDict, deque
+import json
+import logging
+import os
+import Queue
+import signal
+import socket
+from SocketServer import ThreadingMixIn, UnixStreamServer
+import threading
+import time
+import urlparse
+from . import ArgumentsException, LIB_NAME
+from .batch import parse_job
+
+logger = logging.getLogger(LIB_NAME)
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+class JobState(object):
+    """
+    Job of the service and its progress
+    """
+    def __init__(self, job):
+        """
+        :type job: fb2tools.batch.Job
+        """
+        self.job = job
+        self.status = QUEUED
+        self.submitted = time.time()
+        self.started = self.finished = None
+        self.finishedEvent = threading.Event()
+
+    def asDict(self):
+        d = OrderedDict([('id', self.job.number), ('status', self.status), ('output', self.job.options.output)])
+        if self.started is not None:
+            d['wait'] = self.started - self.submitted
+        if self.finished is not None:
+            d['run'] = self.finished - self.started
+        return d
+
+def _percentiles(values):
+    if not values:
+        return None
+
+    values = sorted(values)
+    pick = lambda p: values[min(len(values) - 1, int(len(values) * p))]
+    return OrderedDict([
+        ('mean', sum(values) / len(values)), ('p50', pick(0.5)), ('p95', pick(0.95)), ('max', values[-1]),
+    ])
+
+class MergeService(object):
+    """
+    Runs merge jobs on a fixed number of worker threads, fed from a bounded queue.
+    Everything the process keeps between jobs, the compiled schema and the
+    memory cache of prepared books, is shared by all of them
+    """
+    # Finished jobs kept for status requests, and jobs kept for latency figures
+    HISTORY = 1000
+
+    def __init__(self, run, defaults, check=None, workers=1, queueSize=64, cache=None):
+        """
+        :param run: run(options, paths), False or exception when the job failed
+        :param defaults: options of jobs that manifest entries do not set
+        :param check: check(options) raises ArgumentsException for bad job options
+        :type cache: fb2tools.cache.MemoryCache
+        """
+        self._run = run
+        self._defaults = defaults
+        self._check = check
+        self._cache = cache
+        self._queue = Queue.Queue(queueSize)
+        self._jobs = OrderedDict()
+        self._latency = deque(maxlen=self.HISTORY)
+        self._lock = threading.Lock()
+        self._next = 0
+        self._running = 0
+        self._counts = dict.fromkeys([DONE, FAILED, 'rejected'], 0)
+        self._started = time.time()
+
+        for n in xrange(workers):
+            worker = threading.Thread(target=self._work, name='merge-worker-%d' % n)
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, entry):
+        """
+        Queues a job given as a manifest entry
+
+        :rtype: JobState
+        :raise Queue.Full: queue is full
+        """
+        with self._lock:
+            number = self._next
+            self._next += 1
+
+        job = parse_job(number, entry, self._defaults)
+        # Threads of one process share the jobs, a job needs no process pool
+        job.options.jobs = 1
+        if self._check is not None:
+            self._check(job.options)
+
+        state = JobState(job)
+        with self._lock:
+            self._jobs[number] = state
+        try:
+            self._queue.put_nowait(state)
+        except Queue.Full:
+            with self._lock:
+                del self._jobs[number]
+                self._counts['rejected'] += 1
+            raise
+
+        return state
+
+    def get(self, number):
+        """
+        :rtype: JobState
+        """
+        with self._lock:
+            return self._jobs.get(number)
+
+    def _work(self):
+        while True:
+            state = self._queue.get()
+            with self._lock:
+                self._running += 1
+            state.status, state.started = RUNNING, time.time()
+
+            try:
+                ok = self._run(state.job.options, state.job.paths) is not False
+            except Exception, e:
+                logger.exception('%s failed: %s' % (state.job, e))
+                ok = False
+
+            state.finished = time.time()
+            state.status = DONE if ok else FAILED
+            logger.info('%s %s in %.2fs' % (state.job, state.status, state.finished - state.started))
+
+            with self._lock:
+                self._running -= 1
+                self._counts[state.status] += 1
+                self._latency.append((state.started - state.submitted, state.finished - state.started))
+                finished = [n for n, s in self._jobs.iteritems() if s.finished is not None]
+                for number in finished[:len(finished) - self.HISTORY]:
+                    del self._jobs[number]
+            state.finishedEvent.set()
+
+    def stats(self):
+        with self._lock:
+            latency = list(self._latency)
+            stats = OrderedDict([
+                ('uptime', time.time() - self._started),
+                ('queued', self._queue.qsize()),
+                ('running', self._running),
+                ('done', self._counts[DONE]),
+                ('failed', self._counts[FAILED]),
+                ('rejected', self._counts['rejected']),
+            ])
+
+        stats['wait'] = _percentiles([wait for wait, _run in latency])
+        stats['run'] = _percentiles([run for _wait, run in latency])
+        if self._cache is not None:
+            stats['cache'] = self._cache.stats()
+        return stats
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """
+    JSON over HTTP:
+
+        POST /jobs          manifest entry, queues a job; ?wait=1 answers when it is finished
+        GET  /jobs/ID       state of a job
+        GET  /stats         queue depth, job counts, latency and cache figures
+
+    Jobs are posted as application/json, which browsers do not send to other
+    origins without a preflight the service never answers. On TCP the Host
+    header must name the address the server listens on, which stops pages of
+    DNS rebinding names from reaching it
+    """
+    server_version = 'fb2merge'
+
+    def _reply(self, code, body):
+        data = json.dumps(body, indent=2)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _hostAllowed(self):
+        hosts = self.server.hosts
+        return hosts is None or self.headers.get('Host', '').lower() in hosts
+
+    def do_GET(self):
+        if not self._hostAllowed():
+            return self._reply(400, {'error': 'Unexpected Host header'})
+
+        service = self.server.service
+        path = urlparse.urlparse(self.path).path.rstrip('/')
+
+        if path == '/stats':
+            return self._reply(200, service.stats())
+
+        parts = path.split('/')
+        if len(parts) == 3 and parts[1] == 'jobs' and parts[2].isdigit():
+            state = service.get(int(parts[2]))
+            if state is not None:
+                return self._reply(200, state.asDict())
+
+        self._reply(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        if not self._hostAllowed():
+            return self._reply(400, {'error': 'Unexpected Host header'})
+
+        url = urlparse.urlparse(self.path)
+        if url.path.rstrip('/') != '/jobs':
+            return self._reply(404, {'error': 'Not found'})
+
+        contentType = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        if contentType != 'application/json':
+            return self._reply(415, {'error': 'Jobs must be posted as application/json'})
+
+        try:
+            entry = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            state = self.server.service.submit(entry)
+        except (ValueError, ArgumentsException), e:
+            return self._reply(400, {'error': str(e)})
+        except Queue.Full:
+            return self._reply(503, {'error': 'Queue is full'})
+
+        if urlparse.parse_qs(url.query).get('wait', ['0'])[0] not in ('', '0'):
+            state.finishedEvent.wait()
+            return self._reply(200 if state.status == DONE else 500, state.asDict())
+
+        self._reply(202, state.asDict())
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'local'
+
+    def log_message(self, format, *args):
+        logger.debug('%s %s' % (self.address_string(), format % args))
+
+class _HTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class _UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+        # Only the owner may connect, the socket is never accessible to others
+        umask = os.umask(0177)
+        try:
+            UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+
+def is_loopback(host):
+    try:
+        return socket.gethostbyname(host).startswith('127.')
+    except socket.error:
+        return False
+
+def allowed_hosts(host, address):
+    """
+    Host header values naming a server listening on address:
+    the host it was given, its address and localhost, with the port.
+    Names are not resolved, other names of loopback addresses are refused
+    """
+    ip, port = address[:2]
+    names = set(name.lower() for name in (host, ip, 'localhost'))
+    hosts = set('%s:%d' % (name, port) for name in names)
+    if port == 80:
+        hosts.update(names)
+    return hosts
+
+def make_server(address, service):
+    """
+    Jobs read and write any files the service can, so there is no
+    listening beyond this host: TCP hosts must be loopback addresses,
+    Unix sockets are created with mode 0600
+
+    :param address: HOST:PORT or :PORT for HTTP on TCP, otherwise path of a Unix socket
+    :type service: MergeService
+    """
+    host, _sep, port = address.rpartition(':')
+    if port.isdigit() and '/' not in address:
+        host = host or '127.0.0.1'
+        if not is_loopback(host):
+            raise ArgumentsException('Not a loopback address: %s, the service has no authentication' % host)
+
+        server = _HTTPServer((host, int(port)), ServiceHandler)
+        server.hosts = allowed_hosts(host, server.server_address)
+    else:
+        server = _UnixHTTPServer(address, ServiceHandler)
+        # Browsers do not connect to Unix sockets, clients send any Host
+        server.hosts = None
+
+    server.service = service
+    return server
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def serve(address, service):
+    """
+    Serves until interrupted or terminated
+    """
+    server = make_server(address, service)
+    signal.signal(signal.SIGTERM, _interrupt)
+    logger.info('Serving on %s' % address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info('Stopped')
+    finally:
+        server.server_close()
+        if isinstance(server, _UnixHTTPServer) and os.path.exists(address):
+            os.unlink(address)
@@ -0,0 +1,75 @@
+# coding=utf-8
+import cPickle as pickle
+import heapq
+import tempfile
+from lxml import etree
+from .xml import build_element as _e
+
+class SectionRuns(object):
+    """
+    Sections and notes of inserted books, kept serialized: in memory
+    up to budget bytes, beyond it in sorted run files on disk.
+    Iterating merges the runs, so books come out ordered by key,
+    books with equal keys in the order they were added
+    """
+    def __init__(self, budget):
+        """
+        :param budget: bytes of serialized books held in memory
+        """
+        self._budget = budget
+        self._buffer = []
+        self._size = 0
+        self._runs = []
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, key, bookID, section, notes):
+        # Wrapping rebinds namespace prefixes as inserting into the merged tree does
+        record = (
+            tuple(key), self._count, bookID,
+            etree.tostring(_e('body', None, section)),
+            etree.tostring(_e('body', None, *notes)),
+        )
+        self._count += 1
+        self._buffer.append(record)
+        self._size += len(record[3]) + len(record[4])
+        if self._size > self._budget:
+            self._flush()
+
+    def _flush(self):
+        self._buffer.sort()
+        run = tempfile.TemporaryFile(prefix='fb2run')
+        for record in self._buffer:
+            pickle.dump(record, run, pickle.HIGHEST_PROTOCOL)
+
+        self._runs.append(run)
+        self._buffer = []
+        self._size = 0
+
+    @classmethod
+    def _read(cls, run):
+        run.seek(0)
+        while True:
+            try:
+                yield pickle.load(run)
+            except EOFError:
+                return
+
+    def __iter__(self):
+        """
+        Yields (key, bookID, section, notes, size) in key order,
+        size is the length of the serialized section and notes
+        """
+        self._buffer.sort()
+        runs = [self._read(run) for run in self._runs] + [iter(self._buffer)]
+        for key, _count, bookID, section, notes in heapq.merge(*runs):
+            yield key, bookID, etree.fromstring(section)[0], list(etree.fromstring(notes)), len(section) + len(notes)
+
+    def close(self):
+        for run in self._runs:
+            run.close()
+
+        self._runs = []
+        self._buffer = []
@@ -0,0 +1,128 @@
+# coding=utf-8
+import copy
+import hashlib
+from lxml import etree
+from . import fb2tag
+from . import inputs
+from .cache import SqliteCache
+from .xml import build_element as _e
+
+VALIDATE_NONE = 'none'
+VALIDATE_INPUT = 'input'
+VALIDATE_OUTPUT = 'output'
+VALIDATE_ALL = 'all'
+
+VALIDATE_MODES = [VALIDATE_NONE, VALIDATE_INPUT, VALIDATE_OUTPUT, VALIDATE_ALL]
+
+def validates_input(mode):
+    return mode in (VALIDATE_INPUT, VALIDATE_ALL)
+
+def validates_output(mode):
+    return mode in (VALIDATE_OUTPUT, VALIDATE_ALL)
+
+class HashingReader(object):
+    """
+    File object wrapper hashing everything read through it
+    """
+    def __init__(self, fo):
+        self._fo = fo
+        self._m = hashlib.sha1()
+
+    def read(self, size=-1):
+        data = self._fo.read(size)
+        self._m.update(data)
+        return data
+
+    def close(self):
+        self._fo.close()
+
+    @property
+    def name(self):
+        return self._fo.name
+
+    def hexdigest(self):
+        return self._m.hexdigest()
+
+class ValidationCache(SqliteCache):
+    """
+    Persistent record of books that passed schema validation,
+    keyed by path, size, mtime and content hash
+    """
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS valid ('
+        'path TEXT, size INTEGER, mtime REAL, sha1 TEXT, '
+        'PRIMARY KEY (path, size, mtime, sha1))'
+    ]
+
+    @classmethod
+    def key(cls, path, digest):
+        return inputs.stat(path) + (digest,)
+
+    def passed(self, key):
+        c = self._connection().execute(
+            'SELECT 1 FROM valid WHERE path = ? AND size = ? AND mtime = ? AND sha1 = ?', key
+        )
+        return c.fetchone() is not None
+
+    def add(self, key):
+        db = self._connection()
+        with db:
+            db.execute('DELETE FROM valid WHERE path = ?', key[:1])
+            db.execute('INSERT INTO valid VALUES (?, ?, ?, ?)', key)
+
+# Children the schema requires even in the smallest valid element
+_STUB_CONTENT = {
+    fb2tag('poem'): lambda: [_e('stanza', None, _e('v', None))],
+    fb2tag('table'): lambda: [_e('tr', None, _e('td', None))],
+}
+
+def stub(element):
+    """
+    Smallest valid element with the tag and attributes (but id) of element
+    """
+    e = _e(element.tag, None, *_STUB_CONTENT.get(element.tag, list)())
+    for k, v in element.attrib.iteritems():
+        if k != 'id':
+            e.attrib[k] = v
+
+    return e
+
+def stub_description():
+    """
+    Smallest valid description, stands in for the real one
+    when parts of a book are validated separately
+    """
+    author = lambda: _e('author', None, _e('nickname', 'stub'))
+    return _e('description', None,
+        _e('title-info', None, _e('genre', 'sf'), author(), _e('book-title', 'stub'), _e('lang', 'en')),
+        _e('document-info', None, author(), _e('date', '2000'), _e('id', 'stub'), _e('version', '1.0')),
+    )
+
+def skeleton(element, depth, keep=(fb2tag('title'),)):
+    """
+    Copy of element down to depth levels, deeper children are replaced
+    with stubs. Elements with tags in keep are copied as is.
+    Validating a skeleton checks the structure the merge builds
+    while trusting content of already validated books
+    """
+    e = _e(element.tag, None)
+    e.attrib.update(element.attrib)
+    for child in element:
+        if not isinstance(child.tag, basestring):
+            continue
+
+        if child.tag in keep:
+            e.append(copy.deepcopy(child))
+        elif depth > 1:
+            e.append(skeleton(child, depth - 1, keep))
+        else:
+            e.append(stub(child))
+
+    return e
+
+def assert_unique_ids(ids):
+    seen = set()
+    for id in ids:
+        if id in seen:
+            raise etree.DocumentInvalid('Duplicate id #%s' % id)
+        seen.add(id)
@@ -0,0 +1,117 @@
+# coding=utf-8
+from contextlib import contextmanager
+from lxml import etree
+from . import FB2_NSMAP_OUT, fb2tag
+
+class StreamWriter(object):
+    """
+    Incremental FictionBook writer on lxml etree.xmlfile: elements are
+    serialized one by one into the output file, so the document never
+    exists as a single string. Namespaces are declared on the root element,
+    every element written whole is serialized by lxml with the declarations
+    it needs, so large subtrees are better written whole than child by child
+    """
+    def __init__(self, fo, nsmap=None, newlines=True):
+        self._fo = fo
+        self._nsmap = nsmap or FB2_NSMAP_OUT
+        self.newlines = newlines
+        self._xf = None
+
+    @contextmanager
+    def document(self, **attrib):
+        with etree.xmlfile(self._fo, encoding='utf-8') as xf:
+            self._xf = xf
+            xf.write_declaration()
+            try:
+                with xf.element(fb2tag('FictionBook'), attrib, nsmap=self._nsmap):
+                    self._newline()
+                    yield self
+                # Text is only allowed within the root element
+                if self.newlines:
+                    self.raw('\n')
+            finally:
+                self._xf = None
+
+    @contextmanager
+    def element(self, tag, **attrib):
+        if tag[0] != '{':
+            tag = fb2tag(tag)
+
+        with self._element(tag, attrib):
+            yield self
+
+    def write(self, element):
+        self._xf.write(element)
+        if not element.tail:
+            self._newline()
+
+    def chunked(self, tag, chunks, attrib):
+        """
+        Writes an element with text content coming in pieces, e.g. base64 data
+        """
+        if tag[0] != '{':
+            tag = fb2tag(tag)
+
+        with self._element(tag, attrib, newlines=False):
+            for chunk in chunks:
+                self._xf.write(chunk)
+
+    def raw(self, data):
+        """
+        Writes data that is already serialized XML, e.g. elements
+        spooled by write_fragment
+        """
+        self._xf.flush()
+        self._fo.write(data)
+
+    def flush(self):
+        self._xf.flush()
+        self._fo.flush()
+
+    @contextmanager
+    def _element(self, tag, attrib, newlines=True):
+        with self._xf.element(tag, attrib):
+            if newlines:
+                self._newline()
+            yield
+        self._newline()
+
+    def _newline(self):
+        if self.newlines:
+            self._xf.write('\n')
+
+def write_fragment(fo, elements, nsmap=None):
+    """
+    Serializes elements into fo one per line, as StreamWriter writes
+    children of an element, for spools StreamWriter.raw copies into
+    a document later. Elements are serialized by lxml under a wrapper
+    declaring nsmap, only the wrapper's own tags are cut off; nsmap
+    must be the one of the document the spool is copied into
+    """
+    wrapper = etree.Element(fb2tag('body'), nsmap=nsmap or FB2_NSMAP_OUT)
+    start = etree.tostring(wrapper, encoding='utf-8')[:-2] + '>'
+    end = '</%s>' % start[1:-1].split(None, 1)[0]
+
+    for e in elements:
+        wrapper.append(e)
+        if not e.tail:
+            e.tail = '\n'
+
+    if len(wrapper):
+        data = etree.tostring(wrapper, encoding='utf-8')
+        assert data.startswith(start) and data.endswith(end)
+        fo.write(data[len(start):-len(end)])
+
+def write_element(writer, element):
+    """
+    Writes element through writer. Children of body elements, sections
+    and notes, are put on lines of their own as if written one by one
+    """
+    if element.tag == fb2tag('body') and writer.newlines:
+        if not element.text:
+            element.text = '\n'
+        for child in element:
+            if not child.tail:
+                child.tail = '\n'
+
+    writer.write(element)
@@ -2,13 +2,33 @@
 from lxml import etree
 from . import FB2_NSMAP
 
-TITLE_INFO = etree.XPath('//f:description/f:title-info', namespaces=FB2_NSMAP)
-SRC_TITLE_INFO = etree.XPath('//f:description/f:src-title-info', namespaces=FB2_NSMAP)
-SRC_URL = etree.XPath('//f:description/f:document-info/f:src-url', namespaces=FB2_NSMAP)
-SRC_OCR = etree.XPath('//f:description/f:document-info/f:src-ocr', namespaces=FB2_NSMAP)
+class LazyXPath(object):
+    """
+    etree.XPath compiled on first call
+    """
+    def __init__(self, path, **kwargs):
+        self.path = path
+        self._kwargs = kwargs
+        self._xpath = None
 
-ELEMENTS_WITH_ID = etree.XPath('//*[@id]')
-ELEMENTS_WITH_REF = etree.XPath('//*[@x:href and starts-with(@x:href, "#")]', namespaces=FB2_NSMAP)
+    def __call__(self, _etree_or_element, **kwargs):
+        if self._xpath is None:
+            self._xpath = etree.XPath(self.path, **self._kwargs)
+
+        return self._xpath(_etree_or_element, **kwargs)
+
+TITLE_INFO = LazyXPath('//f:description/f:title-info', namespaces=FB2_NSMAP)
+SRC_TITLE_INFO = LazyXPath('//f:description/f:src-title-info', namespaces=FB2_NSMAP)
+SRC_URL = LazyXPath('//f:description/f:document-info/f:src-url', namespaces=FB2_NSMAP)
+SRC_OCR = LazyXPath('//f:description/f:document-info/f:src-ocr', namespaces=FB2_NSMAP)
+MERGE_INFO = LazyXPath('//f:description/f:custom-info[@info-type = $info_type]', namespaces=FB2_NSMAP)
+
+ELEMENTS_WITH_ID = LazyXPath('//*[@id]')
+ELEMENTS_WITH_REF = LazyXPath('//*[@x:href and starts-with(@x:href, "#")]', namespaces=FB2_NSMAP)
+ELEMENTS_WITH_ID_OR_REF = LazyXPath('//*[@id or starts-with(@x:href, "#")]', namespaces=FB2_NSMAP)
+SUBELEMENTS_WITH_ID_OR_REF = LazyXPath('descendant-or-self::*[@id or starts-with(@x:href, "#")]', namespaces=FB2_NSMAP)
+SUBELEMENTS_WITH_ID = LazyXPath('descendant-or-self::*[@id]')
+SUBELEMENTS_WITH_REF = LazyXPath('descendant-or-self::*[@x:href and starts-with(@x:href, "#")]', namespaces=FB2_NSMAP)
 
 _eq = lambda x: x
 
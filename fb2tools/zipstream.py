@@ -0,0 +1,120 @@
+# coding=utf-8
+import struct
+import time
+import zlib
+from zipfile import ZIP_STORED, ZIP_DEFLATED
+
+ZIP64_LIMIT = (1 << 32) - 1
+# Value of 32-bit fields moved to a ZIP64 record
+_ZIP64_MARK = 0xffffffff
+
+_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+_LOCAL_ZIP64 = struct.Struct('<2H2Q')
+_CENTRAL_HEADER = struct.Struct('<4s4B4H3L5H2L')
+_ZIP64_END = struct.Struct('<4sQ2H2L4Q')
+_ZIP64_LOCATOR = struct.Struct('<4sLQL')
+_END = struct.Struct('<4s4H2LH')
+
+_FLAG_UTF8 = 0x800
+_ZIP64_VERSION = 45
+_DEFAULT_VERSION = 20
+_UNIX = 3
+
+class ZipStream(object):
+    """
+    Write-only file object storing everything written to it as the single
+    member of a zip archive. Data is compressed as it comes, sizes and CRC
+    are filled into the local header on close, so fo must be seekable.
+    The local header reserves a ZIP64 record, so members may exceed 4 GB
+
+    :param level: zlib compression level, 0 stores data uncompressed
+    """
+    def __init__(self, fo, name, level=zlib.Z_DEFAULT_COMPRESSION):
+        self._fo = fo
+        self._flags = 0
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+            self._flags |= _FLAG_UTF8
+        self._name = name
+
+        if level == 0:
+            self._method, self._compressor = ZIP_STORED, None
+        else:
+            self._method = ZIP_DEFLATED
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+        t = time.localtime()
+        self._dosTime = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+        self._dosDate = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+        self._crc = 0
+        self._size = 0
+        self._compressSize = 0
+        self._offset = fo.tell()
+        self._writeLocalHeader()
+
+    def _writeLocalHeader(self):
+        self._fo.write(_LOCAL_HEADER.pack(
+            'PK\x03\x04', _ZIP64_VERSION, self._flags, self._method, self._dosTime, self._dosDate,
+            self._crc & 0xffffffff, _ZIP64_MARK, _ZIP64_MARK, len(self._name), _LOCAL_ZIP64.size
+        ))
+        self._fo.write(self._name)
+        self._fo.write(_LOCAL_ZIP64.pack(1, _LOCAL_ZIP64.size - 4, self._size, self._compressSize))
+
+    def write(self, data):
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        self._emit(data)
+
+    def _emit(self, data):
+        self._fo.write(data)
+        self._compressSize += len(data)
+
+    def flush(self):
+        self._fo.flush()
+
+    def close(self):
+        if self._compressor is not None:
+            self._emit(self._compressor.flush())
+            self._compressor = None
+
+        end = self._fo.tell()
+        self._fo.seek(self._offset)
+        self._writeLocalHeader()
+        self._fo.seek(end)
+        self._writeDirectory(end)
+        self._fo.flush()
+
+    def _writeDirectory(self, start):
+        zip64 = [x for x in (self._size, self._compressSize, self._offset) if x >= ZIP64_LIMIT]
+        extra = struct.pack('<2H%dQ' % len(zip64), 1, 8 * len(zip64), *zip64) if zip64 else ''
+        limit = lambda x: x if x < ZIP64_LIMIT else _ZIP64_MARK
+        version = _ZIP64_VERSION if zip64 else _DEFAULT_VERSION
+
+        self._fo.write(_CENTRAL_HEADER.pack(
+            'PK\x01\x02', version, _UNIX, version, 0, self._flags, self._method,
+            self._dosTime, self._dosDate, self._crc & 0xffffffff,
+            limit(self._compressSize), limit(self._size),
+            len(self._name), len(extra), 0, 0, 0, 0644 << 16, limit(self._offset)
+        ))
+        self._fo.write(self._name)
+        self._fo.write(extra)
+
+        size = self._fo.tell() - start
+        if start >= ZIP64_LIMIT:
+            end64 = self._fo.tell()
+            self._fo.write(_ZIP64_END.pack(
+                'PK\x06\x06', _ZIP64_END.size - 12, _ZIP64_VERSION, _ZIP64_VERSION, 0, 0, 1, 1, size, start
+            ))
+            self._fo.write(_ZIP64_LOCATOR.pack('PK\x06\x07', 0, end64, 1))
+
+        self._fo.write(_END.pack('PK\x05\x06', 0, 0, 1, 1, size, limit(start), 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
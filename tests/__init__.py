@@ -0,0 +1,77 @@
+# coding=utf-8
+"""
+Tests of fb2tools and fb2merge on books of the benchmark corpus generator.
+
+    python -m unittest discover
+"""
+import os
+import re
+import shutil
+import tempfile
+import unittest
+from lxml import etree
+from benchmarks.corpus import CorpusOptions, generate
+
+# Parts of document-info a merge makes new on every run
+_RUN_INFO = [
+    (re.compile(r'<id>[^<]*</id>'), '<id/>'),
+    (re.compile(r'<version>[^<]*</version>'), '<version/>'),
+    (re.compile(r'<date value="[^"]*">[^<]*</date>'), '<date/>'),
+]
+
+def normalized(data):
+    """
+    Merged book with its document id, version and date blanked,
+    so books merged by different runs compare equal
+    """
+    for pattern, replacement in _RUN_INFO:
+        data = pattern.sub(replacement, data, 1)
+
+    return data
+
+def canonical(data):
+    """
+    C14N form of a normalized merged book: equal for books that differ
+    only in where namespaces are declared
+    """
+    return etree.tostring(etree.fromstring(normalized(data)), method='c14n')
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def merge_options(*args):
+    """
+    fb2merge options for command line arguments
+    """
+    import fb2merge
+
+    options, _args = fb2merge.parser.parse_args(list(args))
+    fb2merge.check_options(options)
+    return options
+
+class CorpusTestCase(unittest.TestCase):
+    """
+    Generates a small corpus into a temporary directory for every test
+    """
+    CORPUS = CorpusOptions(books=6, sections=2, paragraphs=3, notes=4, binary_size=512)
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='fb2test')
+        self.paths = generate(self.path('corpus'), self.CORPUS)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def path(self, name):
+        return os.path.join(self.workdir, name)
+
+    def merge(self, paths, *args):
+        """
+        Runs fb2merge on paths with command line arguments args
+
+        :return: result of fb2merge.merge
+        """
+        import fb2merge
+
+        return fb2merge.merge(merge_options(*args), paths)
@@ -0,0 +1,29 @@
+# coding=utf-8
+import base64
+import unittest
+from fb2tools.book import Book
+from tests import CorpusTestCase
+
+class BookImagesTest(CorpusTestCase):
+    def test_images_after_rebuild_id(self):
+        book = Book.fromFile(self.paths[0])
+        data = book.getImageData(book.getCover())
+
+        book.rebuildID(7, set())
+        # The cover now refers to the binary by its new id
+        self.assertEqual(book.getImageData(book.getCover()), data)
+        self.assertEqual(book.openImage(book.getCover()).read(), data)
+
+    def test_images_after_update_binaries(self):
+        book = Book.fromFile(self.paths[0])
+        data = book.getImageData(book.getCover())
+
+        for binary in book.getBinaries():
+            binary.text = '\n'.join(binary.text[i:i + 76] for i in xrange(0, len(binary.text), 76))
+        book.updateBinaries()
+
+        self.assertEqual(book.getImageData(book.getCover()), data)
+        self.assertEqual(book.getBinaries()[0].text, base64.b64encode(data))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+# coding=utf-8
+import os
+import unittest
+from zipfile import ZipFile, ZIP_DEFLATED
+from benchmarks.corpus import CorpusOptions
+from fb2tools import dedup
+from fb2tools.dedup import DEDUP_EXACT, content_size, deduplicate, sample_hash
+from tests import CorpusTestCase, read
+
+class DedupTest(CorpusTestCase):
+    # Books of several sample blocks
+    CORPUS = CorpusOptions(books=3, sections=3, paragraphs=3, notes=4, binary_size=96 * 1024)
+
+    def zipped(self, path):
+        zipped = self.path(os.path.basename(path) + '.zip')
+        with ZipFile(zipped, 'w', ZIP_DEFLATED) as z:
+            z.write(path, os.path.basename(path))
+        return zipped
+
+    def test_zipped_copy(self):
+        path = self.paths[0]
+        zipped = self.zipped(path)
+        archive = self.path('library.zip')
+        with ZipFile(archive, 'w', ZIP_DEFLATED) as z:
+            z.write(path, 'book.fb2')
+            z.write(zipped, 'book.fb2.zip')
+
+        size = len(read(path))
+        self.assertTrue(size > dedup.SAMPLE_BLOCKS * dedup.SAMPLE_BLOCK)
+        copies = [path, zipped, archive + '!book.fb2', archive + '!book.fb2.zip']
+        self.assertEqual(set(content_size(p) for p in copies), set([size]))
+        self.assertEqual(len(set(sample_hash(p) for p in copies)), 1)
+        self.assertNotEqual(sample_hash(self.paths[1]), sample_hash(path))
+
+        self.assertEqual(deduplicate(copies + self.paths[1:], DEDUP_EXACT), [path] + self.paths[1:])
+
+if __name__ == '__main__':
+    unittest.main()
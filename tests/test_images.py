@@ -0,0 +1,65 @@
+# coding=utf-8
+import base64
+from cStringIO import StringIO
+import unittest
+from fb2tools import images
+from fb2tools.images import ImageCache, ImageOptions, ImageRecompressor
+from fb2tools.prepare import prepareBook
+from tests import CorpusTestCase, normalized, read
+
+def png(width, height):
+    from PIL import Image
+
+    out = StringIO()
+    Image.new('RGB', (width, height), (200, 100, 50)).save(out, 'PNG')
+    return out.getvalue()
+
+@unittest.skipUnless(images.available(), 'needs PIL')
+class ImageRecompressorTest(CorpusTestCase):
+    def prepared(self, bookID=0):
+        prepared = prepareBook(bookID, self.paths[bookID])
+        for binary in prepared.binaries:
+            binary.text = base64.b64encode(png(400, 300))
+        return prepared
+
+    def test_downscale(self):
+        prepared = ImageRecompressor(ImageOptions(maxSize=40, format='jpeg')).process(self.prepared())
+
+        from PIL import Image
+
+        for binary in prepared.binaries:
+            self.assertEqual(binary.attrib['content-type'], 'image/jpeg')
+            self.assertEqual(Image.open(StringIO(base64.b64decode(binary.text))).size, (40, 30))
+
+    def test_cache(self):
+        cache = ImageCache(self.path('cache.sqlite'))
+        first = ImageRecompressor(ImageOptions(maxSize=40), cache).process(self.prepared())
+
+        # Another process, with nothing recompressed in memory
+        images._recent = images._RecentResults(1024)
+        recompress, images.recompress = images.recompress, None
+        try:
+            second = ImageRecompressor(ImageOptions(maxSize=40), cache).process(self.prepared())
+        finally:
+            images.recompress = recompress
+
+        self.assertEqual([b.text for b in second.binaries], [b.text for b in first.binaries])
+
+    def test_recent_results_budget(self):
+        recent = images._RecentResults(3 * images._RecentResults.ENTRY_SIZE)
+        for n in xrange(4):
+            recent.add(n, None)
+        recent.get(1)
+        recent.add(4, None)
+
+        self.assertEqual([recent.get(n)[0] for n in xrange(5)], [False, True, False, True, True])
+
+    def test_merge_in_workers(self):
+        # Corpus images are random bytes, PIL leaves them as they are
+        self.merge(self.paths, '-t', 'Merged', '-o', self.path('plain'))
+        self.merge(self.paths, '-t', 'Merged', '-o', self.path('images'), '-j', '2', '--max-image-size', '40')
+
+        self.assertEqual(normalized(read(self.path('images.fb2'))), normalized(read(self.path('plain.fb2'))))
+
+if __name__ == '__main__':
+    unittest.main()
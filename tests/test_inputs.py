@@ -0,0 +1,72 @@
+# coding=utf-8
+import os
+import unittest
+from zipfile import ZipFile
+from fb2tools import inputs
+from fb2tools.inputs import ReadAhead
+from tests import CorpusTestCase, read
+
+class ReadAheadTest(CorpusTestCase):
+    def test_order_and_data(self):
+        paths = self.paths + [self.path('missing.fb2')]
+        result = list(ReadAhead(paths, depth=3))
+
+        self.assertEqual([path for path, _data in result], paths)
+        for path, data in result[:-1]:
+            self.assertEqual(data, read(path))
+        self.assertIsNone(result[-1][1])
+
+    def test_budget(self):
+        # Inputs larger than the budget are left to be read when parsed
+        result = list(ReadAhead(self.paths, depth=2, budget=1))
+        self.assertEqual([data for _path, data in result], [None] * len(self.paths))
+
+    def test_read_error(self):
+        failing = self.paths[2]
+
+        def failing_read(path):
+            if path == failing:
+                raise IOError('Cannot read %s' % path)
+            return original(path)
+
+        original, inputs.read = inputs.read, failing_read
+        try:
+            iterator = iter(ReadAhead(self.paths, depth=4))
+            self.assertEqual([iterator.next()[0] for _ in xrange(2)], self.paths[:2])
+            self.assertRaises(IOError, iterator.next)
+        finally:
+            inputs.read = original
+
+class ArchiveTest(CorpusTestCase):
+    def archive(self, *paths):
+        archive = self.path('archive.zip')
+        with ZipFile(archive, 'w') as z:
+            for n, path in enumerate(paths):
+                z.write(path, 'book%d.fb2' % n)
+        return archive
+
+    def test_replaced_archive(self):
+        archive = self.archive(self.paths[0], self.paths[1])
+        self.assertEqual(inputs.read(archive + '!book0.fb2'), read(self.paths[0]))
+
+        # Members at other offsets and of other sizes
+        self.archive(self.paths[2])
+        self.assertEqual(inputs.read(archive + '!book0.fb2'), read(self.paths[2]))
+        self.assertFalse(inputs.isfile(archive + '!book1.fb2'))
+        self.assertEqual(inputs.stat(archive + '!book0.fb2')[1:],
+                         (len(read(self.paths[2])), os.stat(archive).st_mtime))
+
+        os.remove(archive)
+        self.assertFalse(inputs.isfile(archive + '!book0.fb2'))
+
+    def test_open_archives(self):
+        for n in xrange(inputs.OPEN_ARCHIVES + 2):
+            archive = self.path('archive%d.zip' % n)
+            with ZipFile(archive, 'w') as z:
+                z.write(self.paths[0], 'book.fb2')
+            self.assertTrue(inputs.isfile(archive + '!book.fb2'))
+
+        self.assertTrue(len(inputs._archives) <= inputs.OPEN_ARCHIVES)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+# coding=utf-8
+import os
+import shutil
+import unittest
+from zipfile import ZipFile
+from fb2tools.library import LibraryIndex, index_library
+from tests import CorpusTestCase
+
+class IndexLibraryTest(CorpusTestCase):
+    def setUp(self):
+        super(IndexLibraryTest, self).setUp()
+        self.index = LibraryIndex(self.path('index.sqlite'))
+
+        for name in ('directory', 'globbed'):
+            os.mkdir(self.path(name))
+        shutil.copy(self.paths[0], self.path('directory'))
+        shutil.copy(self.paths[1], self.path('directory'))
+        shutil.copy(self.paths[2], self.path('globbed'))
+        shutil.copy(self.paths[3], self.path('globbed'))
+        with ZipFile(self.path('archive.zip'), 'w') as z:
+            z.write(self.paths[4], 'a.fb2')
+            z.write(self.paths[5], 'b.fb2')
+
+        self.roots = [self.path('directory'), self.path('globbed/*.fb2'), self.path('archive.zip'), self.paths[5]]
+
+    def indexed(self):
+        c = self.index._connection().execute('SELECT path FROM books')
+        return sorted(os.path.basename(path) for path, in c)
+
+    def test_removed_under_every_root(self):
+        self.assertEqual(index_library(self.roots, self.index), (7, 0, 0, 0))
+
+        os.remove(os.path.join(self.path('directory'), os.path.basename(self.paths[0])))
+        # Nothing matches the glob any more
+        shutil.rmtree(self.path('globbed'))
+        with ZipFile(self.path('archive.zip'), 'w') as z:
+            z.write(self.paths[4], 'a.fb2')
+        os.remove(self.paths[5])
+
+        # The rewritten archive has a new mtime, its book is scanned again
+        self.assertEqual(index_library(self.roots, self.index), (1, 1, 5, 0))
+        self.assertEqual(self.indexed(), sorted(['archive.zip!a.fb2', os.path.basename(self.paths[1])]))
+
+    def test_other_roots_kept(self):
+        index_library(self.roots, self.index)
+        self.assertEqual(index_library([self.path('directory')], self.index), (0, 2, 0, 0))
+        self.assertEqual(len(self.indexed()), 7)
+
+if __name__ == '__main__':
+    unittest.main()
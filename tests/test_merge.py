@@ -0,0 +1,68 @@
+# coding=utf-8
+import os
+import unittest
+from zipfile import ZipFile
+from fb2tools import fb2tag
+from fb2tools.book import Book
+from tests import CorpusTestCase, canonical, normalized, read
+
+class MergeTest(CorpusTestCase):
+    def test_valid_output(self):
+        self.assertTrue(self.merge(self.paths, '-t', 'Merged', '-o', self.path('out')))
+
+        book = Book.fromFile(self.path('out.fb2'))
+        self.assertTrue(book.isValid())
+        self.assertEqual(len(book.getBodies()[0]) - 1, len(self.paths))
+
+    def test_jobs(self):
+        self.merge(self.paths, '-t', 'Merged', '-o', self.path('serial'), '-j', '1')
+        self.merge(self.paths, '-t', 'Merged', '-o', self.path('parallel'), '-j', '2')
+
+        self.assertEqual(normalized(read(self.path('parallel.fb2'))), normalized(read(self.path('serial.fb2'))))
+
+    def test_zip_output(self):
+        self.merge(self.paths, '-t', 'Merged', '-o', self.path('plain'))
+        self.merge(self.paths, '-t', 'Merged', '-o', self.path('zipped'), '-z')
+
+        z = ZipFile(self.path('zipped.fb2.zip'))
+        self.assertIsNone(z.testzip())
+        self.assertEqual(normalized(z.read('book.fb2')), normalized(read(self.path('plain.fb2'))))
+
+    def test_append_to(self):
+        self.merge(self.paths, '-t', 'Merged', '-o', self.path('whole'))
+        self.merge(self.paths[:3], '-t', 'Merged', '-o', self.path('part'))
+        self.merge(self.paths[3:], '-t', 'Merged', '-o', self.path('appended'), '-a', self.path('part.fb2'))
+
+        self.assertEqual(normalized(read(self.path('appended.fb2'))), normalized(read(self.path('whole.fb2'))))
+
+    def test_memory_budget(self):
+        self.merge(self.paths, '-t', 'Merged', '-o', self.path('memory'))
+        self.merge(self.paths, '-t', 'Merged', '-o', self.path('spooled'), '--memory-budget', '1')
+
+        # Spooled books are copied into bodies, namespaces are declared elsewhere
+        self.assertEqual(canonical(read(self.path('spooled.fb2'))), canonical(read(self.path('memory.fb2'))))
+
+    def test_volumes(self):
+        self.assertTrue(self.merge(self.paths, '-t', 'Merged', '-o', self.path('out.fb2'),
+                                   '--max-books-per-volume', '4'))
+
+        self.assertFalse(os.path.exists(self.path('out.fb2')))
+        self.assertFalse(os.path.exists(self.path('out.3.fb2')))
+
+        books = 0
+        for number in (1, 2):
+            volume = Book.fromFile(self.path('out.%d.fb2' % number))
+            self.assertTrue(volume.isValid())
+            self.assertEqual(volume.getTitle(), 'Merged. Volume %d' % number)
+
+            sections = [e for e in volume.getBodies()[0] if e.tag == fb2tag('section')]
+            self.assertTrue(len(sections) <= 4)
+            books += len(sections)
+
+            # Every volume keeps the binaries its books refer to
+            self.assertEqual(len(volume.getBinaries()), 2 * len(sections))
+
+        self.assertEqual(books, len(self.paths))
+
+if __name__ == '__main__':
+    unittest.main()
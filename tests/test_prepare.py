@@ -0,0 +1,81 @@
+# coding=utf-8
+import copy
+import cPickle as pickle
+import os
+import unittest
+from lxml import etree
+from fb2tools import inputs
+from fb2tools.cache import MemoryCache, PrepareCache
+from fb2tools.prepare import prepareBook
+from fb2tools.xml import build_element as _e
+from tests import CorpusTestCase
+
+def serialized(prepared):
+    """
+    Everything of a PreparedBook the merge uses, as strings.
+    Notes and binaries are serialized under a parent, as in the merged book
+    """
+    tostring = lambda e: etree.tostring(e, with_tail=False)
+    inserted = lambda elements: etree.tostring(_e('body', None, *map(copy.deepcopy, elements)))
+    return (
+        prepared.bookID, tuple(prepared.info.key), sorted(prepared.info._refs),
+        tostring(prepared.description), tostring(prepared.section),
+        inserted(prepared.notes), inserted(prepared.binaries),
+    )
+
+class PreparedBookTest(CorpusTestCase):
+    def test_pickle_round_trip(self):
+        prepared = prepareBook(2, self.paths[2])
+        before = serialized(prepared)
+
+        loaded = pickle.loads(pickle.dumps(prepared, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(serialized(loaded), before)
+        # Pickling moves notes and binaries under wrappers, the book must stay usable
+        self.assertEqual(serialized(prepared), before)
+
+    def test_renumber_on_cache_hit(self):
+        cache = PrepareCache(self.path('cache.sqlite'))
+        prepareBook(0, self.paths[1], cache=cache)
+
+        key = cache.key(self.paths[1], validate=True)
+        self.assertIsNotNone(cache.get(key))
+
+        cached = prepareBook(4, self.paths[1], cache=cache)
+        self.assertEqual(serialized(cached), serialized(prepareBook(4, self.paths[1])))
+
+class PrepareCacheTest(CorpusTestCase):
+    def setUp(self):
+        super(PrepareCacheTest, self).setUp()
+        self.hashed = []
+
+        def digest(path, data=None):
+            self.hashed.append(path)
+            return original(path, data)
+
+        original, inputs.digest = inputs.digest, digest
+        self.addCleanup(setattr, inputs, 'digest', original)
+
+    def check_hashing(self, cache, reopen):
+        path = self.paths[0]
+        key = cache.key(path, validate=True)
+        self.assertEqual(cache.key(path, validate=True), key)
+        self.assertEqual(reopen().key(path, validate=False)[0], key[0])
+        self.assertEqual(self.hashed, [path])
+
+        # A changed input is hashed again
+        with open(path, 'ab') as f:
+            f.write('\n')
+        os.utime(path, (0, 0))
+        self.assertNotEqual(cache.key(path, validate=True), key)
+        self.assertEqual(self.hashed, [path, path])
+
+    def test_hashes_on_stat_change(self):
+        filename = self.path('cache.sqlite')
+        self.check_hashing(PrepareCache(filename), lambda: PrepareCache(filename))
+
+    def test_memory_hashes_on_stat_change(self):
+        cache = MemoryCache(1024 * 1024)
+        self.check_hashing(cache, lambda: cache)
+
+if __name__ == '__main__':
+    unittest.main()
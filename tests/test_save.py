@@ -0,0 +1,59 @@
+# coding=utf-8
+import os
+import shutil
+import tempfile
+import unittest
+from zipfile import ZipFile
+from fb2tools.save import SaveXml, SaveZip
+from tests import read
+
+class Failure(Exception):
+    pass
+
+def failing(fo):
+    fo.write('<FictionBook>' + 'x' * 100000)
+    raise Failure()
+
+class SaveTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='fb2test')
+        self.filename = os.path.join(self.workdir, 'book.fb2')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def assertUntouched(self, saver):
+        with open(self.filename, 'wb') as f:
+            f.write('old')
+
+        self.assertRaises(Failure, saver.stream, failing)
+        self.assertEqual(read(self.filename), 'old')
+        self.assertEqual(os.listdir(self.workdir), ['book.fb2'])
+
+    def test_xml(self):
+        SaveXml(self.filename).save('<FictionBook/>')
+        self.assertEqual(read(self.filename), '<FictionBook/>')
+        self.assertEqual(os.listdir(self.workdir), ['book.fb2'])
+
+    def test_xml_failure(self):
+        self.assertUntouched(SaveXml(self.filename))
+
+    def test_zip(self):
+        SaveZip(self.filename, 'book.fb2').save('<FictionBook/>')
+        self.assertEqual(ZipFile(self.filename).read('book.fb2'), '<FictionBook/>')
+
+    def test_zip_failure(self):
+        self.assertUntouched(SaveZip(self.filename, 'book.fb2'))
+
+    def test_failure_without_output(self):
+        self.assertRaises(Failure, SaveXml(self.filename).stream, failing)
+        self.assertEqual(os.listdir(self.workdir), [])
+
+    def test_mode_kept(self):
+        SaveXml(self.filename).save('old')
+        os.chmod(self.filename, 0640)
+        SaveXml(self.filename).save('new')
+        self.assertEqual(os.stat(self.filename).st_mode & 0777, 0640)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+# coding=utf-8
+import functools
+import httplib
+import json
+import os
+import stat
+import threading
+import unittest
+import fb2merge
+from benchmarks.corpus import CorpusOptions
+from fb2tools import ArgumentsException
+from fb2tools.book import Book
+from fb2tools.cache import MemoryCache
+from fb2tools.service import DONE, MergeService, make_server
+from tests import CorpusTestCase, merge_options, normalized, read
+
+class MergeServiceTest(CorpusTestCase):
+    # Enough books for jobs on both workers to overlap
+    CORPUS = CorpusOptions(books=24, sections=2, paragraphs=3, notes=4, binary_size=512)
+
+    def setUp(self):
+        super(MergeServiceTest, self).setUp()
+        # As run_service does, libxml2 complains about the schema compiled in a worker thread
+        Book.loadSchema()
+
+    def service(self, workers=2):
+        cache = MemoryCache(16 * 1024 * 1024)
+        defaults = merge_options('-t', 'Merged', '-o', self.path('unused'))
+        return MergeService(functools.partial(fb2merge.merge, cache=cache), defaults,
+                            fb2merge.check_options, workers, cache=cache)
+
+    def test_concurrent_jobs(self):
+        service = self.service()
+        jobs = [
+            service.submit({'inputs': self.paths, 'output': self.path('all.fb2')}),
+            service.submit({'inputs': self.paths[:3], 'output': self.path('part.fb2')}),
+            service.submit({'inputs': self.paths[3:], 'output': self.path('rest.fb2'), 'validate': 'input'}),
+            service.submit({'inputs': self.paths, 'output': self.path('copy.fb2')}),
+        ]
+        for job in jobs:
+            self.assertTrue(job.finishedEvent.wait(60))
+            self.assertEqual(job.status, DONE)
+
+        for name in ['all', 'part', 'rest', 'copy']:
+            self.assertTrue(Book.fromFile(self.path(name + '.fb2')).isValid())
+
+        self.merge(self.paths, '-t', 'Merged', '-o', self.path('single'))
+        expected = normalized(read(self.path('single.fb2')))
+        self.assertEqual(normalized(read(self.path('all.fb2'))), expected)
+        self.assertEqual(normalized(read(self.path('copy.fb2'))), expected)
+
+        stats = service.stats()
+        self.assertEqual(stats['done'], len(jobs))
+        self.assertTrue(stats['cache']['hits'] > 0)
+
+    def test_loopback_only(self):
+        service = self.service(1)
+        self.assertRaises(ArgumentsException, make_server, '0.0.0.0:0', service)
+
+        server = make_server('localhost:0', service)
+        server.server_close()
+
+    def test_unix_socket_mode(self):
+        address = self.path('service.sock')
+        server = make_server(address, self.service(1))
+        try:
+            self.assertEqual(stat.S_IMODE(os.stat(address).st_mode), 0600)
+        finally:
+            server.server_close()
+
+    def request(self, server, method, path, body=None, headers=None):
+        host, port = server.server_address
+        connection = httplib.HTTPConnection(host, port, timeout=60)
+        try:
+            connection.request(method, path, body, headers or {})
+            response = connection.getresponse()
+            return response.status, json.loads(response.read())
+        finally:
+            connection.close()
+
+    def test_requests_from_browsers(self):
+        service = self.service(1)
+        server = make_server('localhost:0', service)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            port = server.server_address[1]
+            body = json.dumps({'inputs': self.paths[:2], 'output': self.path('posted.fb2')})
+            local = {'Host': 'localhost:%d' % port}
+
+            # A simple request, sent cross-origin without a preflight
+            status, _reply = self.request(server, 'POST', '/jobs?wait=1', body,
+                                          dict(local, **{'Content-Type': 'text/plain'}))
+            self.assertEqual(status, 415)
+
+            # A page of another name resolving to the loopback address
+            rebound = {'Host': 'evil.example:%d' % port, 'Content-Type': 'application/json'}
+            self.assertEqual(self.request(server, 'POST', '/jobs?wait=1', body, rebound)[0], 400)
+            self.assertEqual(self.request(server, 'GET', '/stats', headers=rebound)[0], 400)
+
+            self.assertEqual(service.stats()['done'], 0)
+            self.assertFalse(os.path.exists(self.path('posted.fb2')))
+
+            status, reply = self.request(server, 'POST', '/jobs?wait=1', body,
+                                         dict(local, **{'Content-Type': 'application/json; charset=utf-8'}))
+            self.assertEqual((status, reply['status']), (200, DONE))
+            self.assertTrue(os.path.exists(self.path('posted.fb2')))
+
+            host = {'Host': '127.0.0.1:%d' % port}
+            self.assertEqual(self.request(server, 'GET', '/jobs/%d' % reply['id'], headers=host), (200, reply))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+# coding=utf-8
+import unittest
+from lxml import etree
+from fb2tools.spool import SectionRuns
+from fb2tools.xml import build_element as _e
+
+class SectionRunsTest(unittest.TestCase):
+    def test_spilled_runs_merge_in_key_order(self):
+        keys = [(3, 'c'), (1, 'a'), (2, 'b'), (1, 'a'), (0, 'z'), (2, 'b')]
+        # Every book spills a run of its own
+        runs = SectionRuns(1)
+        for bookID, key in enumerate(keys):
+            runs.add(key, bookID, _e('section', None, _e('p', 'book %d' % bookID)),
+                     [_e('section', None, _e('p', 'note %d' % bookID), id='n%d' % bookID)])
+
+        self.assertEqual(len(runs), len(keys))
+        self.assertEqual(len(runs._runs), len(keys))
+
+        books = list(runs)
+        runs.close()
+
+        # Equal keys keep the order books were added in
+        expected = sorted(range(len(keys)), key=lambda bookID: keys[bookID])
+        self.assertEqual([bookID for _key, bookID, _section, _notes, _size in books], expected)
+        for key, bookID, section, notes, size in books:
+            self.assertEqual(key, keys[bookID])
+            self.assertEqual(section[0].text, 'book %d' % bookID)
+            self.assertEqual([note.attrib['id'] for note in notes], ['n%d' % bookID])
+            self.assertTrue(size > len(etree.tostring(section)))
+
+    def test_in_memory(self):
+        runs = SectionRuns(1024 * 1024)
+        runs.add((1,), 0, _e('section', None, _e('p', 'a')), [])
+        runs.add((0,), 1, _e('section', None, _e('p', 'b')), [])
+
+        self.assertEqual(runs._runs, [])
+        self.assertEqual([bookID for _key, bookID, _section, _notes, _size in runs], [1, 0])
+        runs.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+# coding=utf-8
+from cStringIO import StringIO
+import unittest
+from lxml import etree
+from fb2tools import FB2_NSMAP, X_REF, fb2tag
+from fb2tools.book import Book
+from fb2tools.writer import StreamWriter, write_fragment
+
+BOOK = '''<?xml version="1.0" encoding="utf-8"?>
+<FictionBook xmlns="http://www.gribuser.ru/xml/fictionbook/2.0" xmlns:l="http://www.w3.org/1999/xlink">
+<description><title-info><book-title>xmlns="http://www.gribuser.ru/xml/fictionbook/2.0"</book-title></title-info></description>
+<body>
+<section><p a="&gt; xmlns:l=&quot;x&quot;">text <a l:href="#n1">[1]</a></p></section>
+</body>
+<body name="notes">
+<section id="n1"><p>xmlns:xlink="http://www.w3.org/1999/xlink"</p></section>
+</body>
+<binary id="i" content-type="image/png">AAAA</binary>
+</FictionBook>
+'''
+
+class StreamWriterTest(unittest.TestCase):
+    def test_round_trip(self):
+        # Declarations in text and attributes are content, not markup
+        fo = StringIO()
+        Book(etree.parse(StringIO(BOOK)), validate=False).write(fo)
+
+        written = etree.fromstring(fo.getvalue())
+        tree = etree.parse(StringIO(BOOK))
+        self.assertEqual(etree.tostring(written, method='c14n'), etree.tostring(tree, method='c14n'))
+        self.assertEqual(written.nsmap, tree.getroot().nsmap)
+
+    def test_other_prefixes(self):
+        section = etree.fromstring('<section xmlns="%s" xmlns:x="%s"><p><a x:href="#a">1</a></p></section>'
+                                   % (FB2_NSMAP['f'], FB2_NSMAP['x']))
+        spool = StringIO()
+        write_fragment(spool, [section])
+
+        fo = StringIO()
+        with StreamWriter(fo).document() as w:
+            with w.element('body'):
+                w.raw(spool.getvalue())
+            w.chunked('binary', ['AA', 'AA'], {'id': 'i'})
+
+        root = etree.fromstring(fo.getvalue())
+        self.assertEqual(root.find('.//' + fb2tag('a')).attrib[X_REF], '#a')
+        self.assertEqual(root.find(fb2tag('binary')).text, 'AAAA')
+
+if __name__ == '__main__':
+    unittest.main()
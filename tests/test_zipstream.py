@@ -0,0 +1,58 @@
+# coding=utf-8
+import os
+import shutil
+import tempfile
+import unittest
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+from fb2tools import zipstream
+from fb2tools.zipstream import ZipStream
+
+DATA = ''.join('line %d of the document\n' % n for n in xrange(10000))
+
+class ZipStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='fb2test')
+        self.filename = os.path.join(self.workdir, 'book.fb2.zip')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def write(self, name, level):
+        with open(self.filename, 'wb') as f:
+            with ZipStream(f, name, level) as z:
+                for pos in xrange(0, len(DATA), 4096):
+                    z.write(DATA[pos:pos + 4096])
+
+        return ZipFile(self.filename)
+
+    def assertMember(self, z, name, method):
+        self.assertIsNone(z.testzip())
+        info, = z.infolist()
+        self.assertEqual(info.filename, name)
+        self.assertEqual(info.compress_type, method)
+        self.assertEqual(z.read(info), DATA)
+
+    def test_deflated(self):
+        z = self.write('book.fb2', 6)
+        self.assertMember(z, 'book.fb2', ZIP_DEFLATED)
+        self.assertTrue(z.infolist()[0].compress_size < len(DATA))
+
+    def test_stored(self):
+        self.assertMember(self.write('book.fb2', 0), 'book.fb2', ZIP_STORED)
+
+    def test_unicode_name(self):
+        self.assertMember(self.write(u'книга.fb2', 6), u'книга.fb2', ZIP_DEFLATED)
+
+    def test_zip64_records(self):
+        # Sizes and offsets past a lowered limit take the ZIP64 records of 4 GB members
+        limit = zipstream.ZIP64_LIMIT
+        zipstream.ZIP64_LIMIT = 16
+        try:
+            z = self.write('book.fb2', 6)
+        finally:
+            zipstream.ZIP64_LIMIT = limit
+
+        self.assertMember(z, 'book.fb2', ZIP_DEFLATED)
+
+if __name__ == '__main__':
+    unittest.main()